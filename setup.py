@@ -29,6 +29,8 @@ setup(
         'Flask',
         'Flask-Mako',
         'Flask-Login==0.4.0',
+        # PooledSQLAlchemy overrides create_engine() hook added in 2.4
+        'Flask-SQLAlchemy>=2.4,<3',
         'Flask-User',
         'lxml',
         'pysqlite',
@@ -37,6 +39,7 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     update-users-data = presence_analyzer.script:update_users
+    compile-snapshot = presence_analyzer.script:compile_snapshot
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -3,4 +3,4 @@
 Presence analyzer.
 """
 from .main import app, db
-from . import views
+from . import profiling, views
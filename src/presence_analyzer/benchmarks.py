@@ -0,0 +1,843 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Run them with the buildout interpreter, e.g.:
+    bin/python-console -m presence_analyzer.benchmarks ingest --rows 10000000
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import timeit
+from datetime import date, datetime, timedelta
+from itertools import chain
+
+from lxml import etree
+
+from presence_analyzer.snapshot import read_snapshot, write_snapshot
+from presence_analyzer.store import PresenceLoader, load_presence
+from presence_analyzer.utils import JSON_ENCODERS, load_users
+
+
+def legacy_load_presence(path):
+    """
+    Presence loader used before the fixed-width parser, kept as baseline.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        presence_reader = csv.reader(csvfile, delimiter=',')
+        for row in presence_reader:
+            if len(row) != 4:
+                continue
+
+            try:
+                user_id = int(row[0])
+                day = datetime.strptime(row[1], '%Y-%m-%d').date()
+                start = datetime.strptime(row[2], '%H:%M:%S').time()
+                end = datetime.strptime(row[3], '%H:%M:%S').time()
+            except (ValueError, TypeError):
+                continue
+
+            data.setdefault(user_id, {})[day] = {
+                'start': start,
+                'end': end,
+            }
+
+    return data
+
+
+def legacy_load_users(path):
+    """
+    Users loader building whole XML tree, kept as baseline.
+    """
+    data = {}
+    name_reader = etree.parse(path)
+    server = name_reader.find('server')
+    avatar_base_url = '{0}://{1}'.format(
+        server.find('protocol').text,
+        server.find('host').text
+    )
+    for user in name_reader.find('users').findall('user'):
+        user_id = int(user.attrib['id'])
+        data.setdefault(user_id, {})['avatar'] = '{0}{1}'.format(
+            avatar_base_url,
+            user.find('avatar').text
+        )
+        data[user_id]['name'] = user.find('name').text
+
+    return data
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02}:{1:02}:{2:02}'.format(
+        seconds // 3600,
+        seconds // 60 % 60,
+        seconds % 60,
+    )
+
+
+def generate_presence_csv(path, rows, users=200, seed=0):
+    """
+    Writes presence CSV with given amount of rows, one row per user per day.
+    """
+    rand = random.Random(seed)
+    first_day = date(2000, 1, 3)
+    with open(path, 'w') as csvfile:
+        for i in xrange(rows):
+            day, user_id = divmod(i, users)
+            start = rand.randint(6 * 3600, 11 * 3600)
+            end = start + rand.randint(3600, 10 * 3600)
+            csvfile.write('{0},{1},{2},{3}\r\n'.format(
+                user_id,
+                first_day + timedelta(days=day),
+                format_seconds(start),
+                format_seconds(end),
+            ))
+
+
+def generate_users_xml(path, users):
+    """
+    Writes users XML in the intranet feed format.
+    """
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.stxnext.pl</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in xrange(users):
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>User {0}</name>\n'
+                '        </user>\n'.format(user_id)
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def measure_in_child(function, *args):
+    """
+    Calls function in forked process. Returns wall time in seconds and
+    growth of peak resident memory in kB.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        elapsed = measure(function, *args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '{0} {1}'.format(elapsed, after - before))
+        os._exit(0)  # pylint: disable=protected-access
+
+    os.close(write_end)
+    result = os.read(read_end, 1024)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    elapsed, memory = result.split()
+    return float(elapsed), int(memory)
+
+
+def repeat_call(times, function, *args):
+    """
+    Calls function(*args) 'times' times.
+    """
+    for __ in xrange(times):
+        function(*args)
+
+
+def store_result(results, key, function, *args):
+    """
+    Stores function(*args) under 'key' of 'results' dict, target of threads
+    whose results are needed.
+    """
+    results[key] = function(*args)
+
+
+def measure(function, *args):
+    """
+    Returns wall time of single call in seconds.
+    """
+    started = timeit.default_timer()
+    function(*args)
+    return timeit.default_timer() - started
+
+
+def bench_ingest(args):
+    """
+    Compares strptime based loader with the fixed-width parser.
+    """
+    handle, path = tempfile.mkstemp(suffix='.csv')
+    os.close(handle)
+    try:
+        generate_presence_csv(path, args.rows)
+        print 'ingest: {0} rows, {1:.1f} MB'.format(
+            args.rows,
+            os.path.getsize(path) / 1024.0 / 1024.0,
+        )
+        for name, loader in [
+                ('strptime', legacy_load_presence),
+                ('fixed-width', load_presence),
+        ]:
+            if name == 'strptime' and args.skip_legacy:
+                continue
+            elapsed = measure(loader, path)
+            print '  {0:<12} {1:8.2f} s {2:12.0f} rows/s'.format(
+                name,
+                elapsed,
+                args.rows / elapsed,
+            )
+    finally:
+        os.remove(path)
+
+
+def bench_users(args):
+    """
+    Compares DOM based users loader with the streaming one.
+    """
+    handle, path = tempfile.mkstemp(suffix='.xml')
+    os.close(handle)
+    try:
+        generate_users_xml(path, args.users)
+        print 'users: {0} users, {1:.1f} MB'.format(
+            args.users,
+            os.path.getsize(path) / 1024.0 / 1024.0,
+        )
+        for name, loader in [
+                ('etree.parse', legacy_load_users),
+                ('iterparse', load_users),
+        ]:
+            elapsed, memory = measure_in_child(loader, path)
+            print '  {0:<12} {1:8.2f} s {2:8.1f} MB peak growth'.format(
+                name,
+                elapsed,
+                memory / 1024.0,
+            )
+    finally:
+        os.remove(path)
+
+
+def bench_snapshot(args):
+    """
+    Compares parsing data files with reading their binary snapshot.
+    """
+    directory = tempfile.mkdtemp()
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    path = os.path.join(directory, 'snapshot.bin')
+    try:
+        generate_presence_csv(data_csv, args.rows, users=args.users)
+        generate_users_xml(data_xml, args.users)
+
+        def parse():
+            """
+            Parses data files, returns loader, presence and users.
+            """
+            loader = PresenceLoader(data_csv)
+            return loader, loader.refresh(), load_users(data_xml)
+
+        elapsed = measure(parse)
+        loader, presence, users = parse()
+        write_snapshot(path, presence, loader.state(), users, {})
+        print 'snapshot: {0} rows, {1} users, {2:.1f} MB'.format(
+            args.rows,
+            args.users,
+            os.path.getsize(path) / 1024.0 / 1024.0,
+        )
+        print '  {0:<12} {1:8.3f} s'.format('parse', elapsed)
+        print '  {0:<12} {1:8.3f} s'.format(
+            'snapshot',
+            measure(read_snapshot, path),
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+def process_memory(pid):
+    """
+    Returns resident and proportional set size of process in kB. Pages
+    shared by N processes count fully into RSS and 1/N into PSS.
+    """
+    memory = {}
+    for name in ('status', 'smaps_rollup'):
+        with open('/proc/{0}/{1}'.format(pid, name)) as info:
+            for line in info:
+                key, __, value = line.partition(':')
+                if key in ('VmRSS', 'Pss'):
+                    memory[key] = int(value.split()[0])
+    return memory['VmRSS'], memory['Pss']
+
+
+def run_workers(processes, function, *args):
+    """
+    Forks processes calling function, measures memory of each one after
+    all of them have finished the call. Returns [(rss, pss)] in kB.
+    """
+    ready_read, ready_write = os.pipe()
+    go_read, go_write = os.pipe()
+    pids = []
+    # results of the child, alive until parent has measured memory
+    results = []
+    for __ in xrange(processes):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            os.close(go_write)
+            results.append(function(*args))
+            os.write(ready_write, '.')
+            # wait until parent has measured memory
+            os.read(go_read, 1)
+            os._exit(0)  # pylint: disable=protected-access
+        pids.append(pid)
+
+    os.close(ready_write)
+    os.close(go_read)
+    for pid in pids:
+        os.read(ready_read, 1)
+    memory = [process_memory(pid) for pid in pids]
+    os.close(go_write)
+    os.close(ready_read)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return memory
+
+
+def load_and_aggregate(path, shared):
+    """
+    Loads snapshot and computes aggregates, touching all of its rows.
+    """
+    __, presence = read_snapshot(path, shared=shared)
+    for user_presence in presence.itervalues():
+        user_presence.aggregates  # pylint: disable=pointless-statement
+    return presence
+
+
+def bench_shared(args):
+    """
+    Compares memory of worker processes with private and shared snapshot.
+    """
+    directory = tempfile.mkdtemp()
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    path = os.path.join(directory, 'snapshot.bin')
+    try:
+        generate_presence_csv(data_csv, args.rows, users=args.users)
+        generate_users_xml(data_xml, args.users)
+
+        def save():
+            """
+            Parses data files and saves their snapshot.
+            """
+            loader = PresenceLoader(data_csv)
+            presence = loader.refresh()
+            write_snapshot(
+                path,
+                presence,
+                loader.state(),
+                load_users(data_xml),
+                {},
+            )
+
+        # parsed data must not be inherited by the workers
+        measure_in_child(save)
+        print 'shared: {0} rows, {1} processes, {2:.1f} MB snapshot'.format(
+            args.rows,
+            args.processes,
+            os.path.getsize(path) / 1024.0 / 1024.0,
+        )
+        for name, function, shared in [
+                ('no data', lambda path, shared: None, False),
+                ('private', load_and_aggregate, False),
+                ('shared', load_and_aggregate, True),
+        ]:
+            memory = run_workers(args.processes, function, path, shared)
+            print '  {0:<12} RSS {1:7.1f} MB  PSS {2:7.1f} MB per process, ' \
+                '{3:7.1f} MB PSS in total'.format(
+                    name,
+                    sum(rss for rss, pss in memory) / 1024.0 / len(memory),
+                    sum(pss for rss, pss in memory) / 1024.0 / len(memory),
+                    sum(pss for rss, pss in memory) / 1024.0,
+                )
+    finally:
+        shutil.rmtree(directory)
+
+
+def percentile(values, fraction):
+    """
+    Returns value below which given fraction of sorted values falls.
+    """
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def make_client(data_csv, data_xml, database):
+    """
+    Configures application with given data files and returns test client
+    logged in as a freshly created user.
+    """
+    from presence_analyzer import main as app_main, models
+
+    app_main.app.config.update({
+        'DATA_CSV': data_csv,
+        'DATA_XML': data_xml,
+        'SECRET_KEY': 'benchmark',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+        'WTF_CSRF_ENABLED': False,
+        'USER_PASSWORD_HASH': 'plaintext',
+    })
+    db_adapter = app_main.register_user_manager()
+    db_adapter.add_object(models.User, username='bench', password='bench')
+    db_adapter.commit()
+
+    client = app_main.app.test_client()
+    client.post(
+        '/user/login/',
+        data={'username': 'bench', 'password': 'bench'},
+    )
+    return client
+
+
+def bench_views(args):
+    """
+    Measures latency of API endpoints with warm data cache.
+    """
+    directory = tempfile.mkdtemp()
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    try:
+        generate_presence_csv(data_csv, args.rows, users=args.users)
+        generate_users_xml(data_xml, args.users)
+        client = make_client(
+            data_csv,
+            data_xml,
+            os.path.join(directory, 'db.sqlite'),
+        )
+        print 'views: {0} rows, {1} users, {2} requests per endpoint'.format(
+            args.rows,
+            args.users,
+            args.requests,
+        )
+        rand = random.Random(0)
+        for url in args.urls:
+            # first request loads the data
+            client.get(url.format(user_id=0))
+            timings = []
+            for __ in xrange(args.requests):
+                started = timeit.default_timer()
+                response = client.get(
+                    url.format(user_id=rand.randrange(args.users))
+                )
+                timings.append(timeit.default_timer() - started)
+                assert response.status_code == 200, response.status
+            timings.sort()
+            print '  {0:<40} p50 {1:7.2f} ms  p99 {2:7.2f} ms'.format(
+                url,
+                percentile(timings, 0.5) * 1000,
+                percentile(timings, 0.99) * 1000,
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_json(args):
+    """
+    Compares JSON encoders on payloads returned by API endpoints.
+    """
+    directory = tempfile.mkdtemp()
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    try:
+        generate_presence_csv(data_csv, args.rows, users=args.users)
+        generate_users_xml(data_xml, args.users)
+        client = make_client(
+            data_csv,
+            data_xml,
+            os.path.join(directory, 'db.sqlite'),
+        )
+        payloads = [
+            (url, json.loads(client.get(url.format(user_id=0)).data))
+            for url in args.urls
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+    encoders = []
+    for name in JSON_ENCODERS:
+        try:
+            encoders.append((name, __import__(name).dumps))
+        except ImportError:
+            print '{0} is not installed, skipped'.format(name)
+
+    print 'json: {0} encodings per payload'.format(args.repeat)
+    for url, payload in payloads:
+        print '  {0}'.format(url)
+        for name, encode in encoders:
+            elapsed = measure(repeat_call, args.repeat, encode, payload)
+            print '    {0:<12} {1:8.2f} us per payload'.format(
+                name,
+                elapsed / args.repeat * 1000 * 1000,
+            )
+
+
+# database settings compared by bench_login
+DATABASE_CONFIGS = [
+    ('default', {}),
+    ('queue', {
+        'DATABASE_POOL_SIZE': 10,
+        'DATABASE_BUSY_TIMEOUT': 5000,
+    }),
+    ('queue+wal', {
+        'DATABASE_POOL_SIZE': 10,
+        'DATABASE_BUSY_TIMEOUT': 5000,
+        'DATABASE_JOURNAL_MODE': 'WAL',
+        'DATABASE_SYNCHRONOUS': 'NORMAL',
+    }),
+    ('thread+wal', {
+        'DATABASE_POOL_SIZE': 100,
+        'DATABASE_POOL_PER_THREAD': True,
+        'DATABASE_BUSY_TIMEOUT': 5000,
+        'DATABASE_JOURNAL_MODE': 'WAL',
+        'DATABASE_SYNCHRONOUS': 'NORMAL',
+    }),
+]
+DATABASE_KEYS = set(chain.from_iterable(
+    config for __, config in DATABASE_CONFIGS
+))
+
+
+def run_clients(clients, function, duration):
+    """
+    Calls function(client, suffix) with every test client of 'clients' in
+    its own thread for 'duration' seconds, 'suffix' is unique for every
+    call. Returns sorted timings of successful calls and amount of failed
+    ones.
+    """
+    deadline = timeit.default_timer() + duration
+    timings = []
+    failures = []
+
+    def client_loop(number, client):
+        """
+        Calls function with client until the deadline.
+        """
+        i = 0
+        while timeit.default_timer() < deadline:
+            started = timeit.default_timer()
+            succeeded = function(client, '{0}-{1}'.format(number, i))
+            elapsed = timeit.default_timer() - started
+            (timings if succeeded else failures).append(elapsed)
+            i += 1
+
+    threads = [
+        threading.Thread(target=client_loop, args=(number, client))
+        for number, client in enumerate(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    timings.sort()
+    return timings, len(failures)
+
+
+def bench_login(args):
+    """
+    Measures /user/login/ under parallel clients, while other clients
+    register new users, with several database settings.
+    """
+    from presence_analyzer import main as app_main, models
+
+    app = app_main.app
+
+    def login(client, _suffix):
+        """
+        Logs in as the benchmark user.
+        """
+        response = client.post(
+            '/user/login/',
+            data={'username': 'bench', 'password': 'bench'},
+        )
+        return response.status_code == 302
+
+    def register(client, suffix):
+        """
+        Registers new user.
+        """
+        response = client.post(
+            '/user/register/',
+            data={
+                'username': 'bench-' + suffix,
+                'password': 'bench_password',
+            },
+        )
+        return response.status_code == 302
+
+    print 'login: {0} clients, {1} registering, {2} s per setting'.format(
+        args.clients,
+        args.writers,
+        args.duration,
+    )
+    directory = tempfile.mkdtemp()
+    try:
+        for name, config in DATABASE_CONFIGS:
+            for key in DATABASE_KEYS:
+                app.config.pop(key, None)
+            app.config.update(config)
+            # new database file, so that a new engine is created
+            app.config.update({
+                'SECRET_KEY': 'benchmark',
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                    directory,
+                    name + '.sqlite',
+                ),
+                'WTF_CSRF_ENABLED': False,
+                'USER_PASSWORD_HASH': 'plaintext',
+                'USER_CACHE_TTL': 0,
+            })
+            db_adapter = app_main.register_user_manager()
+            db_adapter.add_object(
+                models.User,
+                username='bench',
+                password='bench',
+            )
+            db_adapter.commit()
+            app_main.db.session.remove()
+
+            results = {}
+            writers = threading.Thread(
+                target=store_result,
+                args=(
+                    results,
+                    'register',
+                    run_clients,
+                    [app.test_client() for __ in xrange(args.writers)],
+                    register,
+                    args.duration,
+                ),
+            )
+            writers.start()
+            results['login'] = run_clients(
+                [app.test_client() for __ in xrange(args.clients)],
+                login,
+                args.duration,
+            )
+            writers.join()
+
+            print '  {0}'.format(name)
+            for kind in ('login', 'register'):
+                print_timings(kind, *results[kind], duration=args.duration)
+            app_main.db.get_engine().dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+def print_timings(kind, timings, failures, duration):
+    """
+    Prints throughput and latency of run_clients() results.
+    """
+    if not timings:
+        print '    {0:<8} no successful requests, {1} failed'.format(
+            kind,
+            failures,
+        )
+        return
+    print '    {0:<8} {1:7.1f} req/s  p50 {2:7.2f} ms  p99 {3:7.2f} ms  ' \
+        '{4} failed'.format(
+            kind,
+            len(timings) / float(duration),
+            percentile(timings, 0.5) * 1000,
+            percentile(timings, 0.99) * 1000,
+            failures,
+        )
+
+
+def bench_auth(args):  # pylint: disable=too-many-locals
+    """
+    Measures API latency while other clients log in with bcrypt hashed
+    passwords, verified by request threads and by password workers.
+    """
+    from presence_analyzer import main as app_main, models, passwords
+
+    app = app_main.app
+    directory = tempfile.mkdtemp()
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    try:
+        generate_presence_csv(data_csv, args.rows, users=args.users)
+        generate_users_xml(data_xml, args.users)
+        app.config.update({
+            'DATA_CSV': data_csv,
+            'DATA_XML': data_xml,
+            'SECRET_KEY': 'benchmark',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(
+                directory,
+                'db.sqlite',
+            ),
+            'WTF_CSRF_ENABLED': False,
+            'USER_PASSWORD_HASH': 'bcrypt',
+            'PASSWORD_QUEUE_LIMIT': args.queue_limit,
+        })
+        db_adapter = app_main.register_user_manager()
+        user_manager = app.user_manager  # pylint: disable=no-member
+        db_adapter.add_object(
+            models.User,
+            username='bench',
+            password=user_manager.hash_password('bench'),
+        )
+        db_adapter.commit()
+
+        def login(client, _suffix):
+            """
+            Logs in as the benchmark user.
+            """
+            response = client.post(
+                '/user/login/',
+                data={'username': 'bench', 'password': 'bench'},
+            )
+            return response.status_code == 302
+
+        def api(client, suffix):
+            """
+            Requests API of a user chosen by suffix.
+            """
+            response = client.get(
+                args.url.format(user_id=hash(suffix) % args.users),
+            )
+            return response.status_code == 200
+
+        api_clients = []
+        for __ in xrange(args.api_clients):
+            client = app.test_client()
+            login(client, '')
+            api_clients.append(client)
+        # first request loads the data
+        api(api_clients[0], '')
+
+        print 'auth: {0} logging in, {1} calling {2}, {3} s per ' \
+            'setting'.format(
+                args.clients,
+                args.api_clients,
+                args.url,
+                args.duration,
+            )
+        for workers in (0, args.workers):
+            app.config['PASSWORD_WORKERS'] = workers
+            passwords.start_pool()
+            results = {}
+            logins = threading.Thread(
+                target=store_result,
+                args=(
+                    results,
+                    'login',
+                    run_clients,
+                    [app.test_client() for __ in xrange(args.clients)],
+                    login,
+                    args.duration,
+                ),
+            )
+            logins.start()
+            results['api'] = run_clients(api_clients, api, args.duration)
+            logins.join()
+
+            print '  {0} password workers'.format(workers)
+            for kind in ('api', 'login'):
+                print_timings(kind, *results[kind], duration=args.duration)
+        passwords.close_pool()
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    """
+    Parses command line and runs selected benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers()
+
+    ingest = commands.add_parser('ingest', help=bench_ingest.__doc__)
+    ingest.add_argument('--rows', type=int, default=10 * 1000 * 1000)
+    ingest.add_argument(
+        '--skip-legacy',
+        action='store_true',
+        help='do not run the slow strptime loader',
+    )
+    ingest.set_defaults(function=bench_ingest)
+
+    users = commands.add_parser('users', help=bench_users.__doc__)
+    users.add_argument('--users', type=int, default=100 * 1000)
+    users.set_defaults(function=bench_users)
+
+    snapshot = commands.add_parser('snapshot', help=bench_snapshot.__doc__)
+    snapshot.add_argument('--rows', type=int, default=1000 * 1000)
+    snapshot.add_argument('--users', type=int, default=200)
+    snapshot.set_defaults(function=bench_snapshot)
+
+    shared = commands.add_parser('shared', help=bench_shared.__doc__)
+    shared.add_argument('--rows', type=int, default=10 * 1000 * 1000)
+    shared.add_argument('--users', type=int, default=2000)
+    shared.add_argument('--processes', type=int, default=4)
+    shared.set_defaults(function=bench_shared)
+
+    views = commands.add_parser('views', help=bench_views.__doc__)
+    views.add_argument('--rows', type=int, default=1000 * 1000)
+    views.add_argument('--users', type=int, default=200)
+    views.add_argument('--requests', type=int, default=500)
+    views.add_argument('urls', nargs='*', default=[
+        '/api/v1/mean_time_weekday/{user_id}',
+        '/api/v1/presence_weekday/{user_id}',
+        '/api/v1/start_end_weekday/{user_id}',
+        '/api/v1/month_and_year/{user_id}',
+    ])
+    views.set_defaults(function=bench_views)
+
+    encoders = commands.add_parser('json', help=bench_json.__doc__)
+    encoders.add_argument('--rows', type=int, default=100 * 1000)
+    encoders.add_argument('--users', type=int, default=1000)
+    encoders.add_argument('--repeat', type=int, default=1000)
+    encoders.add_argument('urls', nargs='*', default=[
+        '/api/v1/users',
+        '/api/v1/months',
+        '/api/v1/mean_time_weekday/{user_id}',
+        '/api/v1/presence_weekday/{user_id}',
+        '/api/v1/start_end_weekday/{user_id}',
+        '/api/v1/month_and_year/{user_id}',
+        '/api/v1/top_employees/2000/2',
+    ])
+    encoders.set_defaults(function=bench_json)
+
+    login = commands.add_parser('login', help=bench_login.__doc__)
+    login.add_argument('--clients', type=int, default=50)
+    login.add_argument('--writers', type=int, default=5)
+    login.add_argument('--duration', type=float, default=10)
+    login.set_defaults(function=bench_login)
+
+    auth = commands.add_parser('auth', help=bench_auth.__doc__)
+    auth.add_argument('--rows', type=int, default=100 * 1000)
+    auth.add_argument('--users', type=int, default=200)
+    auth.add_argument('--clients', type=int, default=10)
+    auth.add_argument('--api-clients', type=int, default=10)
+    auth.add_argument('--workers', type=int, default=2)
+    auth.add_argument('--queue-limit', type=int, default=20)
+    auth.add_argument('--duration', type=float, default=10)
+    auth.add_argument('--url', default='/api/v1/mean_time_weekday/{user_id}')
+    auth.set_defaults(function=bench_auth)
+
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
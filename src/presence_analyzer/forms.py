@@ -5,6 +5,7 @@ Defines forms.
 from flask_wtf.form import FlaskForm
 from wtforms import HiddenField, PasswordField, TextField, validators
 from presence_analyzer.main import app
+from presence_analyzer.passwords import verify_password
 
 
 class LoginOrRegisterForm(FlaskForm):
@@ -39,7 +40,7 @@ class LoginForm(LoginOrRegisterForm):
             is_valid = (
                 user and
                 user.password and
-                user_manager.verify_password(self.password.data, user)
+                verify_password(self.password.data, user)
             )
 
             if is_valid:
@@ -2,16 +2,141 @@
 """
 Flask app initialization.
 """
-from flask import Flask
+import time
+from timeit import default_timer
+
+from flask import Flask, g, request
 from flask.ext.mako import MakoTemplates
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_user import SQLAlchemyAdapter, UserManager
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.pool import (
+    NullPool,
+    QueuePool,
+    SingletonThreadPool,
+    StaticPool,
+)
+
+from presence_analyzer.metrics import (
+    LATENCY_BUCKETS,
+    SIZE_BUCKETS,
+    Counter,
+    Histogram,
+)
 
 app = Flask(__name__)  # pylint: disable=invalid-name
 MakoTemplates(app)
 
-db = SQLAlchemy(app)
+
+def pool_options(config, sqlite):
+    """
+    Returns engine options of connection pool configured by
+    'DATABASE_POOL_SIZE', 'DATABASE_POOL_PER_THREAD' and
+    'DATABASE_POOL_PRE_PING'. Pool of size 0 opens connection for every
+    checkout, without 'DATABASE_POOL_SIZE' Flask-SQLAlchemy defaults are
+    kept.
+    """
+    options = {}
+    if config.get('DATABASE_POOL_PRE_PING'):
+        options['pool_pre_ping'] = True
+    size = config.get('DATABASE_POOL_SIZE')
+    if size is None:
+        return options
+
+    if not size:
+        options['poolclass'] = NullPool
+    elif config.get('DATABASE_POOL_PER_THREAD'):
+        # connections over 'size' are closed, even if their threads still
+        # use them, so it should not be lower than amount of threads
+        options.update(poolclass=SingletonThreadPool, pool_size=size)
+    else:
+        options.update(
+            poolclass=QueuePool,
+            pool_size=size,
+            max_overflow=config.get('DATABASE_POOL_MAX_OVERFLOW', 10),
+            pool_timeout=config.get('DATABASE_POOL_TIMEOUT', 30),
+        )
+    if sqlite:
+        # pooled connections are passed between threads, and closed by
+        # other threads than the ones which use them
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+def sqlite_pragmas(config):
+    """
+    Returns PRAGMA statements for new SQLite connections, configured by
+    'DATABASE_BUSY_TIMEOUT' (milliseconds), 'DATABASE_JOURNAL_MODE' and
+    'DATABASE_SYNCHRONOUS'.
+    """
+    pragmas = []
+    # set first, switching journal mode may wait for other connections
+    if config.get('DATABASE_BUSY_TIMEOUT') is not None:
+        pragmas.append(
+            'PRAGMA busy_timeout = {0:d}'.format(
+                config['DATABASE_BUSY_TIMEOUT']
+            )
+        )
+    for pragma, key in [
+            ('journal_mode', 'DATABASE_JOURNAL_MODE'),
+            ('synchronous', 'DATABASE_SYNCHRONOUS'),
+    ]:
+        if config.get(key):
+            pragmas.append('PRAGMA {0} = {1}'.format(pragma, config[key]))
+    return pragmas
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with connection pool and SQLite pragmas taken from
+    'DATABASE_*' config.
+    """
+
+    def create_engine(self, sa_url, engine_opts):
+        """
+        Creates engine, applies pragmas to its new SQLite connections.
+        Overrides hook of Flask-SQLAlchemy 2.4, pinned in setup.py.
+        """
+        config = self.get_app().config
+        # 'sqlite', 'sqlite+pysqlite' etc.
+        sqlite = sa_url.get_backend_name() == 'sqlite'
+        if sqlite and sa_url.database in (None, '', ':memory:'):
+            # every connection opens its own empty in-memory database, so
+            # all threads share one connection, whatever pool is configured
+            engine_opts.update(
+                poolclass=StaticPool,
+                connect_args={'check_same_thread': False},
+            )
+        else:
+            engine_opts.update(pool_options(config, sqlite))
+        engine = super(PooledSQLAlchemy, self).create_engine(
+            sa_url,
+            engine_opts,
+        )
+
+        pragmas = sqlite_pragmas(config) if sqlite else []
+        if pragmas:
+            @event.listens_for(engine, 'connect')
+            def apply_pragmas(dbapi_connection, connection_record):
+                """
+                Executes pragmas on new connection.
+                """
+                cursor = dbapi_connection.cursor()
+                try:
+                    for pragma in pragmas:
+                        cursor.execute(pragma)
+                finally:
+                    cursor.close()
+
+        return engine
+
+
+db = PooledSQLAlchemy(app)  # pylint: disable=invalid-name
+
+# user_id -> (expiry time, column values of user), see load_user()
+user_cache = {}  # pylint: disable=invalid-name
 
 
 def register_login_manager(app):
@@ -41,9 +166,105 @@ def register_user_manager():
             login_form=LoginForm,
             register_form=RegisterForm
         )
+        # replaces loader registered by UserManager
+        app.login_manager.user_loader(load_user)
 
     db.create_all()
     return db_adapter
 
 
+def load_user(user_id):
+    """
+    Loads user of session. Column values of users are kept for
+    'USER_CACHE_TTL' seconds (0 disables caching), so that requests of
+    logged in users do not query the database.
+    """
+    from models import User
+    user_id = int(user_id)
+    entry = user_cache.get(user_id)
+    if entry is not None and entry[0] > time.time():
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        # attaches user to the session without loading it again
+        return db.session.merge(user, load=False)
+
+    user = app.user_manager.get_user_by_id(user_id)
+    ttl = app.config.get('USER_CACHE_TTL', 60)
+    if user is not None and ttl:
+        user_cache[user_id] = (
+            time.time() + ttl,
+            {
+                column.key: getattr(user, column.key)
+                for column in User.__table__.columns
+            },
+        )
+    return user
+
+
+def forget_user(user_id):
+    """
+    Removes user from cache of load_user().
+    """
+    user_cache.pop(int(user_id), None)
+
+
+REQUESTS = Counter(
+    'presence_analyzer_requests_total',
+    'Handled requests.',
+    ('endpoint', 'method', 'status'),
+)
+REQUEST_DURATION = Histogram(
+    'presence_analyzer_request_duration_seconds',
+    'Time spent handling requests, without sending streamed responses.',
+    ('endpoint', ),
+    LATENCY_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    'presence_analyzer_response_size_bytes',
+    'Size of response bodies, streamed ones are not counted.',
+    ('endpoint', ),
+    SIZE_BUCKETS,
+)
+
+
+@app.before_request
+def start_request_timer():
+    """
+    Remembers when handling of request started.
+    """
+    g.request_started = default_timer()
+
+
+def record_request(status, size=None):
+    """
+    Records current request in metrics, see presence_analyzer.metrics.
+    """
+    started = getattr(g, 'request_started', None)
+    # URL rule instead of path, so that there is a label per view
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS.inc(endpoint, request.method, str(status))
+    if started is not None:
+        REQUEST_DURATION.observe(default_timer() - started, endpoint)
+    if size is not None:
+        RESPONSE_SIZE.observe(size, endpoint)
+
+
+@app.after_request
+def record_response(response):
+    """
+    Records request which has got a response.
+    """
+    record_request(response.status_code, response.content_length)
+    return response
+
+
+@app.teardown_request
+def record_failure(error):
+    """
+    Records request which has failed with unhandled exception, such
+    requests do not pass through after_request.
+    """
+    if error is not None:
+        record_request(500)
+
 register_login_manager(app)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and histograms exposed in Prometheus text format.
+
+Every thread records into its own dict, so recording takes no lock. The
+dicts of all threads are summed up when metrics are collected. Values of
+threads which have finished are kept, merged into one dict.
+
+Every process has its own metrics, prefork workers report the requests
+they have served themselves.
+"""
+
+from threading import Lock, current_thread, local
+
+# Content-Type of render() output
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds of histogram buckets, seconds and bytes
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS = (
+    256, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024,
+    4 * 1024 * 1024,
+)
+
+# all metrics, in order of definition
+registry = []
+
+
+class Metric(object):
+    """
+    Metric with given label names. Values are kept per thread,
+    {label values: value}.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._local = local()
+        # (thread, values) of threads which have recorded something
+        self._shards = []
+        # values recorded by threads which have finished
+        self._retired = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def values(self):
+        """
+        Returns values of current thread, modified by that thread only.
+        """
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((current_thread(), values))
+            return values
+
+    def merge(self, total, values):  # pylint: disable=no-self-use
+        """
+        Adds values recorded by a thread to total.
+        """
+        for key, value in values.iteritems():
+            total[key] = total.get(key, 0) + value
+
+    def collect(self):
+        """
+        Returns values summed up over all threads.
+        """
+        total = {}
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                # dict() copies at once, the owner may be recording
+                copied = dict(values)
+                if thread.is_alive():
+                    alive.append((thread, values))
+                    self.merge(total, copied)
+                else:
+                    self.merge(self._retired, copied)
+            self._shards = alive
+            self.merge(total, self._retired)
+        return total
+
+    def samples(self):
+        """
+        Returns (name suffix, {label: value}, value) samples to render.
+        """
+        return [
+            ('', dict(zip(self.labels, key)), value)
+            for key, value in sorted(self.collect().iteritems())
+        ]
+
+    def clear(self):
+        """
+        Forgets recorded values.
+        """
+        with self._lock:
+            for __, values in self._shards:
+                values.clear()
+            self._retired.clear()
+
+
+class Counter(Metric):
+    """
+    Monotonically growing value.
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        """
+        Increases value of given label values by 'amount', 1 by default.
+        """
+        values = self.values()
+        values[labels] = values.get(labels, 0) + kwargs.get('amount', 1)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in buckets of given upper bounds.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, amount, *labels):
+        """
+        Records value for given label values.
+        """
+        values = self.values()
+        # (count of every bucket, sum, count), replaced as a whole, so
+        # that collect() never sees it half updated
+        previous = values.get(labels)
+        if previous is None:
+            previous = ((0, ) * len(self.buckets), 0, 0)
+        counts, total, count = previous
+        values[labels] = (
+            tuple(
+                bucket_count + 1 if amount <= bound else bucket_count
+                for bucket_count, bound in zip(counts, self.buckets)
+            ),
+            total + amount,
+            count + 1,
+        )
+
+    def merge(self, total, values):
+        for key, (counts, amount, count) in values.iteritems():
+            if key in total:
+                previous = total[key]
+                counts = tuple(
+                    first + second
+                    for first, second in zip(previous[0], counts)
+                )
+                amount += previous[1]
+                count += previous[2]
+            total[key] = (counts, amount, count)
+
+    def samples(self):
+        samples = []
+        for key, (counts, amount, count) in sorted(
+                self.collect().iteritems()
+        ):
+            labels = dict(zip(self.labels, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples.append(
+                    ('_bucket', dict(labels, le=repr(float(bound))),
+                     bucket_count)
+                )
+            samples.append(('_bucket', dict(labels, le='+Inf'), count))
+            samples.append(('_sum', labels, amount))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class Callback(Metric):
+    """
+    Metric whose values, {label values: value}, are returned by
+    'function' when they are collected.
+    """
+
+    def __init__(self, name, documentation, labels, function, kind='gauge'):
+        super(Callback, self).__init__(name, documentation, labels)
+        self.kind = kind
+        self.function = function
+
+    def collect(self):
+        return self.function()
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def format_value(value):
+    """
+    Formats sample value.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text format.
+    """
+    lines = []
+    for metric in registry:
+        lines.append(
+            '# HELP {0} {1}'.format(metric.name, metric.documentation)
+        )
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+        for suffix, labels, value in metric.samples():
+            if labels:
+                labels = '{{{0}}}'.format(','.join(
+                    '{0}="{1}"'.format(name, escape(label))
+                    for name, label in sorted(labels.iteritems())
+                ))
+            else:
+                labels = ''
+            lines.append('{0}{1}{2} {3}'.format(
+                metric.name,
+                suffix,
+                labels,
+                format_value(value),
+            ))
+    return '\n'.join(lines) + '\n'
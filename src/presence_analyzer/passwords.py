@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing and verification in a pool of worker processes.
+
+Hashing is slow on purpose, so it is done by 'PASSWORD_WORKERS' processes
+instead of the threads serving requests, which keep serving the API while
+users log in. At most 'PASSWORD_QUEUE_LIMIT' passwords wait for the
+workers, further requests are answered with 503 right away, as are the
+ones waiting longer than 'PASSWORD_TIMEOUT' seconds. Without
+'PASSWORD_WORKERS', or before start_pool() is called, passwords are hashed
+by the calling thread.
+
+Worker processes are forked by start_pool() at startup, before threads
+serving requests exist, and again in every prefork worker.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from threading import Lock, Thread
+
+from flask_user import passwords
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# seconds between checks if parent of worker process is still running
+PARENT_CHECK_INTERVAL = 1
+
+pool = None
+# pool belongs to the process which created it, forked processes need
+# their own
+pool_pid = None
+# passwords whose callers wait for workers
+pending = 0
+pool_lock = Lock()
+
+# CryptContext.to_string() -> CryptContext, used in worker processes
+crypt_contexts = {}
+
+
+class PasswordWorkersBusy(ServiceUnavailable):
+    """
+    Raised when password workers have too much work queued.
+    """
+    description = 'Too many users are logging in, please try again.'
+
+    def get_headers(self, environ=None):
+        """
+        Asks client to retry shortly.
+        """
+        return super(PasswordWorkersBusy, self).get_headers(environ) + [
+            ('Retry-After', '1'),
+        ]
+
+
+class Hasher(object):
+    """
+    Settings of UserManager needed by flask_user.passwords functions, in a
+    form which can be sent to worker processes.
+    """
+
+    def __init__(self, user_manager):
+        self.password_hash = user_manager.password_hash
+        self.password_hash_mode = user_manager.password_hash_mode
+        self.password_salt = user_manager.password_salt
+        self.context = user_manager.password_crypt_context.to_string()
+
+    @property
+    def password_crypt_context(self):
+        """
+        CryptContext of UserManager, created once per process.
+        """
+        try:
+            return crypt_contexts[self.context]
+        except KeyError:
+            context = CryptContext.from_string(self.context)
+            crypt_contexts[self.context] = context
+            return context
+
+
+def watch_parent(parent_pid):
+    """
+    Exits worker process when its parent is gone. Parent which exits with
+    os._exit(), like prefork workers do, does not stop the pool itself.
+    """
+    while os.getppid() == parent_pid:
+        time.sleep(PARENT_CHECK_INTERVAL)
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def init_worker():
+    """
+    Makes worker process ignore signals meant for the server and exit
+    together with its parent.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    watcher = Thread(target=watch_parent, args=(os.getppid(),))
+    watcher.daemon = True
+    watcher.start()
+
+
+def start_pool():
+    """
+    Starts 'PASSWORD_WORKERS' worker processes of current process. Pool
+    inherited from the parent process is left to it.
+    """
+    global pool, pool_pid, pending  # pylint: disable=global-statement
+    workers = app.config.get('PASSWORD_WORKERS')
+    with pool_lock:
+        if not workers or pool_pid == os.getpid():
+            return
+        pool = multiprocessing.Pool(workers, initializer=init_worker)
+        pool_pid = os.getpid()
+        pending = 0
+    log.info('Started %d password workers', workers)
+
+
+def call(function, args, deadline):
+    """
+    Returns function(*args), runs in worker process. Password is skipped
+    when its caller has stopped waiting before a worker took it.
+    """
+    if time.time() > deadline:
+        return None
+    return function(*args)
+
+
+def close_pool():
+    """
+    Stops worker processes of current process.
+    """
+    global pool, pool_pid, pending  # pylint: disable=global-statement
+    with pool_lock:
+        if pool_pid == os.getpid():
+            pool.terminate()
+            pool.join()
+        pool = pool_pid = None
+        pending = 0
+
+
+def run(function, *args):
+    """
+    Returns function(*args) computed by password workers. Raises
+    PasswordWorkersBusy when there are too many passwords queued, or the
+    result takes too long.
+    """
+    workers = app.config.get('PASSWORD_WORKERS')
+    if not workers or pool_pid != os.getpid():
+        return function(*args)
+
+    global pending  # pylint: disable=global-statement
+    with pool_lock:
+        if pending >= app.config.get('PASSWORD_QUEUE_LIMIT', 2 * workers):
+            log.warning('Password workers are busy')
+            raise PasswordWorkersBusy()
+        pending += 1
+    timeout = app.config.get('PASSWORD_TIMEOUT', 10)
+    try:
+        result = pool.apply_async(
+            call,
+            (function, args, time.time() + timeout),
+        )
+        # worker killed meanwhile never finishes its password
+        return result.get(timeout)
+    except multiprocessing.TimeoutError:
+        log.warning('Password workers timed out')
+        raise PasswordWorkersBusy()
+    finally:
+        with pool_lock:
+            pending -= 1
+
+
+def hash_password(password):
+    """
+    Hashes password the way app.user_manager does.
+    """
+    return run(passwords.hash_password, Hasher(app.user_manager), password)
+
+
+def verify_password(password, user):
+    """
+    Checks password of user the way app.user_manager does.
+    """
+    user_manager = app.user_manager
+    try:
+        return run(
+            passwords.verify_password,
+            Hasher(user_manager),
+            password,
+            user_manager.get_password(user),
+        )
+    except ValueError:
+        # legacy hashes are checked and replaced by Flask-User
+        return user_manager.verify_password(password, user)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking WSGI server.
+
+The parent process loads the data and binds the listening socket, then
+forks worker processes which inherit both. The data is shared by all the
+workers copy-on-write instead of being loaded by each of them, and the
+CPU bound views run in parallel instead of waiting for the GIL. Every
+worker serves one request at a time.
+
+The parent reacts to signals:
+ - HUP: loads the data again, starts new workers and stops the old ones
+   once they have finished the requests in progress,
+ - TERM, INT: stops the workers the same way and exits.
+"""
+
+import errno
+import os
+import signal
+import sys
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# seconds between checks of workers and signals
+CHECK_INTERVAL = 1
+# seconds given to workers to finish requests in progress before they
+# are killed
+GRACEFUL_TIMEOUT = 30
+
+
+class PreforkWSGIServer(BaseWSGIServer):
+    """
+    WSGI server shared by worker processes.
+    """
+    multiprocess = True
+    # accept() is tried by all workers, the ones which lose return
+    # to the loop instead of blocking
+    timeout = CHECK_INTERVAL
+    requests_served = 0
+    # a connection has been accepted and not closed yet
+    busy = False
+
+    def get_request(self):
+        """
+        Accepts connection, raises socket.error when there is none.
+        """
+        request = BaseWSGIServer.get_request(self)
+        self.busy = True
+        return request
+
+    def shutdown_request(self, request):
+        """
+        Closes connection and counts served requests.
+        """
+        BaseWSGIServer.shutdown_request(self, request)
+        self.requests_served += 1
+        self.busy = False
+
+
+class Arbiter(object):
+    """
+    Keeps 'workers' worker processes serving 'app'. Worker exits after
+    serving 'max_requests' requests and is replaced, 0 means no limit.
+
+    Data should be loaded before run() is called, 'on_reload' is called to
+    load it again before new workers are started by reload. 'post_fork' is
+    called in every worker right after it is started.
+    """
+
+    def __init__(self, app, host, port, workers, max_requests=0,
+                 on_reload=None, post_fork=None):
+        self.server = PreforkWSGIServer(host, port, app)
+        self.server.socket.setblocking(False)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.on_reload = on_reload
+        self.post_fork = post_fork
+        # pid -> generation of worker, generation grows with every reload
+        self.children = {}
+        self.generation = 0
+        self._signals = []
+
+    def run(self):
+        """
+        Starts workers and manages them until stopped by a signal.
+        """
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signalled)
+        log.info(
+            'Serving on %s:%d with %d workers',
+            self.server.host,
+            self.server.port,
+            self.workers,
+        )
+
+        while True:
+            self._reap()
+            if self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self._spawn_missing()
+            time.sleep(CHECK_INTERVAL)
+
+    def reload(self):
+        """
+        Loads data again and replaces all workers.
+        """
+        log.info('Reloading')
+        if self.on_reload is not None:
+            self.on_reload()
+        old = [
+            pid for pid, generation in self.children.iteritems()
+            if generation == self.generation
+        ]
+        self.generation += 1
+        self._spawn_missing()
+        self._kill(old, signal.SIGTERM)
+
+    def stop(self):
+        """
+        Stops workers gracefully, kills the ones which do not stop within
+        GRACEFUL_TIMEOUT.
+        """
+        log.info('Stopping')
+        self._kill(list(self.children), signal.SIGTERM)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while self.children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        self._kill(list(self.children), signal.SIGKILL)
+        while self.children:
+            self._reap(block=True)
+        self.server.server_close()
+
+    def _signalled(self, signum, frame):
+        """
+        Signal handler, the signal is handled by the main loop.
+        """
+        self._signals.append(signum)
+
+    def _kill(self, pids, signum):
+        """
+        Sends signal to worker processes which are still running.
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+
+    def _reap(self, block=False):
+        """
+        Forgets workers which have exited.
+        """
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.ECHILD:
+                    self.children.clear()
+                    return
+                raise
+            if not pid:
+                return
+            if self.children.pop(pid, None) is not None and status:
+                log.warning('Worker %d exited with status %d', pid, status)
+            if block:
+                return
+
+    def _spawn_missing(self):
+        """
+        Starts workers of current generation until there are enough.
+        """
+        current = sum(
+            1 for generation in self.children.itervalues()
+            if generation == self.generation
+        )
+        for __ in xrange(self.workers - current):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker()
+            self.children[pid] = self.generation
+
+    def _run_worker(self):
+        """
+        Serves requests in forked worker process, never returns.
+        """
+        stopping = []
+
+        def stop(signum, frame):
+            """
+            Exits right away when idle, otherwise after current request.
+            """
+            if not self.server.busy:
+                os._exit(0)  # pylint: disable=protected-access
+            stopping.append(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        # request in progress is not interrupted, it is finished first
+        signal.siginterrupt(signal.SIGTERM, False)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            if self.post_fork is not None:
+                self.post_fork()
+            while not stopping:
+                self.server.handle_request()
+                if self.max_requests and \
+                        self.server.requests_served >= self.max_requests:
+                    break
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)  # pylint: disable=protected-access
+
+
+def daemonize(log_file, pid_file):
+    """
+    Detaches current process from terminal, redirects its output to
+    'log_file' and writes its pid to 'pid_file'.
+    """
+    if os.fork():
+        os._exit(0)  # pylint: disable=protected-access
+    os.setsid()
+    if os.fork():
+        os._exit(0)  # pylint: disable=protected-access
+
+    with open(os.devnull, 'r') as devnull:
+        os.dup2(devnull.fileno(), sys.stdin.fileno())
+    with open(log_file, 'a') as output:
+        os.dup2(output.fileno(), sys.stdout.fileno())
+        os.dup2(output.fileno(), sys.stderr.fileno())
+    with open(pid_file, 'w') as pidfile:
+        pidfile.write(str(os.getpid()))
+
+
+def running_pid(pid_file):
+    """
+    Returns pid stored in 'pid_file' if that process is running.
+    """
+    try:
+        with open(pid_file) as pidfile:
+            pid = int(pidfile.read().strip())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return None
+    return pid
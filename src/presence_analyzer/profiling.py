@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of sampled requests.
+
+'PROFILE_SAMPLE_RATE' fraction of requests, 0 by default, runs under
+cProfile. Statistics of the ones taking at least 'PROFILE_THRESHOLD'
+seconds are saved in 'PROFILE_DIR', at most 'PROFILE_MAX_FILES' files.
+Request with PROFILE_HEADER header set to 'PROFILE_SECRET' is always
+profiled and saved.
+
+Saved profiles are summarized by: bin/flask-ctl profile
+"""
+
+import cProfile
+from datetime import datetime
+import hmac
+import os
+import pstats
+import random
+import re
+import sys
+from timeit import default_timer
+
+from flask import g, request
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PROFILE_HEADER = 'X-Profile'
+DEFAULT_DIR = os.path.join('var', 'log', 'profiles')
+# <time>-<pid>-<duration>ms-<path>.pstats
+FILE_NAME = re.compile(
+    r'^(?P<time>\d{8}T\d{6}\.\d{6})-(?P<pid>\d+)-(?P<duration>\d+)ms-'
+    r'(?P<path>.*)\.pstats$'
+)
+UNSAFE_CHARACTERS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def is_requested():
+    """
+    Checks if request asks to be profiled with PROFILE_HEADER header.
+    """
+    secret = app.config.get('PROFILE_SECRET')
+    value = request.headers.get(PROFILE_HEADER)
+    return bool(secret and value) and hmac.compare_digest(
+        str(value),
+        str(secret),
+    )
+
+
+def profile_directory(config):
+    """
+    Returns directory profiles are saved in.
+    """
+    return config.get('PROFILE_DIR') or DEFAULT_DIR
+
+
+def profile_name(duration):
+    """
+    Returns name of file for profile of current request.
+    """
+    path = UNSAFE_CHARACTERS.sub('_', request.path).strip('_') or 'index'
+    return '{0:%Y%m%dT%H%M%S.%f}-{1}-{2:d}ms-{3}.pstats'.format(
+        datetime.now(),
+        os.getpid(),
+        int(duration * 1000),
+        path[:100],
+    )
+
+
+@app.before_request
+def start_profiler():
+    """
+    Starts profiling sampled and requested requests.
+    """
+    requested = is_requested()
+    if not requested and \
+            random.random() >= app.config.get('PROFILE_SAMPLE_RATE', 0):
+        return
+    profiler = cProfile.Profile()
+    g.profiler = (profiler, requested, default_timer())
+    profiler.enable()
+
+
+@app.teardown_request
+def stop_profiler(error):
+    """
+    Stops profiling, saves profile of slow or requested request.
+    """
+    profiler, requested, started = getattr(g, 'profiler', (None, ) * 3)
+    if profiler is None:
+        return
+    profiler.disable()
+    duration = default_timer() - started
+    if not requested and duration < app.config.get('PROFILE_THRESHOLD', 1):
+        return
+
+    directory = profile_directory(app.config)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        elif len(os.listdir(directory)) >= \
+                app.config.get('PROFILE_MAX_FILES', 1000):
+            log.warning('Too many profiles in %s, not saving', directory)
+            return
+        profiler.dump_stats(
+            os.path.join(directory, profile_name(duration))
+        )
+    except EnvironmentError:
+        log.exception('Cannot save profile in %s', directory)
+
+
+def summarize(directory, limit=20, sort='cumulative', match='',
+              stream=None):
+    """
+    Writes list of profiles saved in directory, whose file names contain
+    'match', and their statistics merged, 'limit' functions ordered by
+    'sort' key of pstats. Returns amount of profiles.
+    """
+    stream = stream or sys.stdout
+    profiles = []
+    # directory is created when the first profile is saved
+    names = os.listdir(directory) if os.path.isdir(directory) else []
+    for name in sorted(names):
+        parsed = FILE_NAME.match(name)
+        if parsed is not None and match in name:
+            profiles.append((os.path.join(directory, name), parsed))
+    if not profiles:
+        stream.write('No profiles in {0}\n'.format(directory))
+        return 0
+
+    durations = {}
+    for path, parsed in profiles:
+        durations.setdefault(parsed.group('path'), []).append(
+            int(parsed.group('duration'))
+        )
+    stream.write('{0:>6} {1:>9} {2:>9}  {3}\n'.format(
+        'count', 'mean ms', 'max ms', 'path'
+    ))
+    for path, path_durations in sorted(
+            durations.iteritems(),
+            key=lambda item: -max(item[1]),
+    ):
+        stream.write('{0:>6} {1:>9} {2:>9}  {3}\n'.format(
+            len(path_durations),
+            sum(path_durations) / len(path_durations),
+            max(path_durations),
+            path,
+        ))
+    stream.write('\n')
+
+    stats = pstats.Stats(profiles[0][0], stream=stream)
+    for path, parsed in profiles[1:]:
+        stats.add(path)
+    # files are listed above already
+    stats.files = []
+    stats.sort_stats(sort).print_stats(limit)
+    return len(profiles)
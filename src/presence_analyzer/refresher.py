@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Background refreshing of data when data files change.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+from threading import Thread
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import PRESENCE_FILES, files_version, refresh_data
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# inotify events which mean that a file in watched directory has changed
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE |
+    IN_DELETE
+)
+
+
+class InotifyWatcher(object):
+    """
+    Waits for changes in directories of given files with Linux inotify.
+    Raises OSError when inotify is not available.
+    """
+
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.fd = libc.inotify_init()
+        except AttributeError:
+            raise OSError('inotify is not supported')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        # files are often replaced, so their directories are watched
+        for directory in set(
+                os.path.dirname(os.path.abspath(path)) for path in paths
+        ):
+            if isinstance(directory, unicode):
+                directory = directory.encode(sys.getfilesystemencoding())
+            if libc.inotify_add_watch(self.fd, directory, INOTIFY_MASK) < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), 'Cannot watch ' + directory)
+
+    def wait(self, timeout):
+        """
+        Waits until something changes or 'timeout' seconds pass.
+        """
+        if select.select([self.fd], [], [], timeout)[0]:
+            # events are not needed, the caller checks files itself
+            os.read(self.fd, 64 * 1024)
+
+    def close(self):
+        """
+        Stops watching.
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Fallback for systems without inotify, files are checked every time
+    'timeout' passes.
+    """
+
+    def __init__(self, paths):
+        pass
+
+    def wait(self, timeout):
+        """
+        Waits 'timeout' seconds.
+        """
+        time.sleep(timeout)
+
+    def close(self):
+        """
+        Does nothing.
+        """
+
+
+def make_watcher(paths):
+    """
+    Returns InotifyWatcher of given paths if possible, PollingWatcher
+    otherwise.
+    """
+    try:
+        return InotifyWatcher(paths)
+    except OSError:
+        log.info('inotify is not available, polling data files')
+        return PollingWatcher(paths)
+
+
+class DataRefresher(Thread):
+    """
+    Daemon thread calling 'callback' whenever files under 'config_keys'
+    of app config change. Files are checked on every change in their
+    directories, and every 'interval' seconds anyway.
+    """
+
+    def __init__(self, config_keys, callback, interval):
+        super(DataRefresher, self).__init__(name='data-refresher')
+        self.daemon = True
+        self.config_keys = config_keys
+        self.callback = callback
+        self.interval = interval
+        self.version = files_version(config_keys)
+        self.watcher = make_watcher(
+            app.config[config_key] for config_key in config_keys
+        )
+        self.stopping = False
+
+    def run(self):
+        try:
+            while not self.stopping:
+                self.watcher.wait(self.interval)
+                self.check()
+        finally:
+            self.watcher.close()
+
+    def check(self):
+        """
+        Calls callback if files have changed since the previous call.
+        """
+        version = files_version(self.config_keys)
+        if version == self.version:
+            return
+        started = time.time()
+        try:
+            self.callback()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing data failed')
+            return
+        # version is taken before the callback, changes made in the
+        # meantime will be picked up by the next check
+        self.version = version
+        log.info('Data refreshed in %.3f s', time.time() - started)
+
+    def stop(self):
+        """
+        Stops the thread after its current wait.
+        """
+        self.stopping = True
+
+
+def start_refresher():
+    """
+    Starts DataRefresher of presence and users data if DATA_REFRESH_INTERVAL
+    is configured. Returns the thread, or None.
+    """
+    interval = app.config.get('DATA_REFRESH_INTERVAL')
+    if not interval:
+        return None
+    refresher = DataRefresher(PRESENCE_FILES, refresh_data, interval)
+    refresher.start()
+    return refresher
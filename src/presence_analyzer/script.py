@@ -3,7 +3,10 @@
 # pylint:skip-file
 
 import os
+import signal
 import sys
+import time
+from ConfigParser import RawConfigParser
 from functools import partial
 
 import paste.script.command
@@ -26,7 +29,9 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False,
+             password_workers=True):
+    """Configure the application, start password workers if serving."""
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
@@ -34,6 +39,19 @@ def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer.main import register_user_manager
     register_user_manager()
 
+    # indexes are built now instead of on the first request
+    from presence_analyzer.utils import get_data, load_snapshot
+    if load_snapshot():
+        get_data()
+
+    # workers are forked before any other threads are started
+    if password_workers:
+        from presence_analyzer.passwords import start_pool
+        start_pool()
+
+    from presence_analyzer.refresher import start_refresher
+    app.refresher = start_refresher()
+
     return app
 
 
@@ -48,7 +66,7 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = make_app(password_workers=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
@@ -82,22 +100,96 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+def _prefork(action, dry_run=False):
+    """Run pre-forking server configured in [prefork] of deploy.ini."""
+    from presence_analyzer import prefork
+
+    ini = abspath(DEPLOY_INI)
+    pid_file = abspath('var', 'log', '.prefork.pid')
+    pid = prefork.running_pid(pid_file)
+    print 'prefork {0} ({1})'.format(action, ini)
+    if dry_run:
+        return
+
+    if action in ('stop', 'restart', 'reload'):
+        if pid is None:
+            print 'Not running'
+        elif action == 'reload':
+            os.kill(pid, signal.SIGHUP)
+            return
+        else:
+            os.kill(pid, signal.SIGTERM)
+            while prefork.running_pid(pid_file) is not None:
+                time.sleep(0.5)
+        if action != 'restart':
+            return
+    elif action == 'status':
+        print 'Running, pid {0}'.format(pid) if pid else 'Not running'
+        return
+    elif pid is not None:
+        print 'Already running, pid {0}'.format(pid)
+        return
+
+    parser = RawConfigParser()
+    parser.read(ini)
+    settings = dict(parser.items('prefork'))
+    if action in ('start', 'restart'):
+        prefork.daemonize(abspath('var', 'log', 'prefork.log'), pid_file)
+
+    import logging.config
+    logging.config.fileConfig(ini)
+    # every worker starts its own password workers, see post_fork()
+    app = make_app(password_workers=False)
+
+    # workers share data loaded before they are forked, changed data is
+    # loaded again by reloading them all
+    from presence_analyzer.main import db
+    from presence_analyzer.passwords import start_pool
+    from presence_analyzer.utils import get_data, reload_data
+    get_data()
+    if app.refresher is not None:
+        app.refresher.callback = partial(os.kill, os.getpid(), signal.SIGHUP)
+    arbiter = prefork.Arbiter(
+        app,
+        settings['host'],
+        int(settings['port']),
+        int(settings['workers']),
+        max_requests=int(settings['max_requests']),
+        on_reload=reload_data,
+        post_fork=partial(post_fork, db, start_pool),
+    )
+    arbiter.run()
+
+
+def post_fork(db, start_pool):
+    """Prepare prefork worker process right after it is forked."""
+    # database connections must not be shared with the parent
+    db.engine.dispose()
+    start_pool()
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|status] [--prefork]
+    def action_serve(action=('a', 'start'), prefork=False, dry_run=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
         configuration file for the server and application.
 
         Options:
-         - 'action' is one of [fg|start|stop|restart|status]
+         - 'action' is one of [fg|start|stop|restart|status], with
+           '--prefork' also 'reload'
+         - '--prefork' serve with worker processes forked after loading
+           the data, see presence_analyzer.prefork
          - '--dry-run' print the paster command and exit
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        if prefork:
+            _prefork(action, dry_run=dry_run)
+        else:
+            _serve(action, debug=False, dry_run=dry_run)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -114,6 +206,26 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl profile
+    def action_profile(limit=20, sort='cumulative', match=''):
+        """Summarize profiles of slow requests.
+
+        Profiles are saved by profiling mode, see presence_analyzer.profiling.
+
+        Options:
+         - '--limit' number of functions to list
+         - '--sort' pstats sort key, e.g. cumulative, time, calls
+         - '--match' only profiles whose file names contain it,
+           e.g. api_v1_top_employees
+        """
+        from presence_analyzer import app
+        from presence_analyzer.profiling import profile_directory, summarize
+        app.config.from_pyfile(abspath(DEPLOY_CFG))
+        directory = profile_directory(app.config)
+        if not os.path.isabs(directory):
+            directory = abspath(directory)
+        summarize(directory, limit=limit, sort=sort, match=match)
+
     werkzeug.script.run()
 
 
@@ -123,6 +235,17 @@ def update_users():
     Downloads file from app.config['URL_XML'] and saves it as
     app.config['DATA_XML'].
     """
-    app = make_app({}, config=DEPLOY_CFG, debug=False)
+    app = make_app({}, config=DEPLOY_CFG, password_workers=False)
     import urllib
     urllib.urlretrieve(app.config['URL_XML'], app.config['DATA_XML'])
+
+
+# bin/compile-snapshot
+def compile_snapshot():
+    """
+    Parses app.config['DATA_CSV'] and app.config['DATA_XML'] and saves
+    them as app.config['DATA_SNAPSHOT'].
+    """
+    make_app({}, config=DEPLOY_CFG, password_workers=False)
+    from presence_analyzer.utils import save_snapshot
+    save_snapshot()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshot of parsed presence and users data.
+
+Snapshot file consists of:
+ - preamble: magic string, format version and header length,
+ - header: JSON document with checksums of source files, presence loader
+   state and users, padded to multiple of 8 bytes,
+ - user index: (user_id, first row, amount of rows) triples,
+ - days, months, starts and ends columns of all users, one after another.
+Index and columns are arrays of COLUMN_TYPECODE in byte order given in
+the header.
+
+Snapshot can be read into private arrays or shared: memory mapped, with
+columns being ctypes arrays over the mapping. Mapped pages belong to the
+page cache, so all processes sharing a snapshot use one copy of the data.
+"""
+
+from array import array
+import base64
+import ctypes
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from presence_analyzer.store import COLUMN_TYPECODE, UserPresence
+
+MAGIC = 'PASNAP\0\0'
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct('<8sII')
+# ctypes equivalent of COLUMN_TYPECODE, used for mapped columns
+MAPPED_TYPE = ctypes.c_int
+ALIGNMENT = 8
+# amount of bytes read at once while computing checksums
+BLOCK_SIZE = 1024 * 1024
+
+
+def file_checksum(path, size=None):
+    """
+    Returns SHA-1 hex digest of file contents, of its first 'size' bytes
+    when given.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        if size is None:
+            for block in iter(lambda: source.read(BLOCK_SIZE), ''):
+                digest.update(block)
+        else:
+            while size > 0:
+                block = source.read(min(size, BLOCK_SIZE))
+                if not block:
+                    break
+                digest.update(block)
+                size -= len(block)
+    return digest.hexdigest()
+
+
+def source_info(path):
+    """
+    Returns size, mtime and checksum of source file.
+    """
+    stat = os.stat(path)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': file_checksum(path),
+    }
+
+
+def prefix_info(path, size):
+    """
+    Returns size and checksum of the first 'size' bytes of source file,
+    the part which has been parsed, to be added to its source_info().
+    """
+    return {
+        'prefix_size': size,
+        'prefix_sha1': file_checksum(path, size),
+    }
+
+
+def is_current(info, path):
+    """
+    Checks if source file has not changed since source_info() was taken.
+    Checksum is computed only when size or mtime differ.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if (stat.st_size, stat.st_mtime) == (info['size'], info['mtime']):
+        return True
+    return stat.st_size == info['size'] and \
+        file_checksum(path) == info['sha1']
+
+
+def is_appended(info, path):
+    """
+    Checks if source file still starts with the part described by
+    prefix_info() in 'info', so that it has only been appended to since.
+    """
+    if 'prefix_size' not in info:
+        return False
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    return size >= info['prefix_size'] and \
+        file_checksum(path, info['prefix_size']) == info['prefix_sha1']
+
+
+def write_snapshot(path, presence, loader_state, users, sources):
+    """
+    Writes snapshot of {user_id: UserPresence}, PresenceLoader state and
+    {user_id: {'name': ..., 'avatar': ...}} users. 'sources' maps names of
+    source files to their source_info(). File is replaced atomically.
+    """
+    user_ids = sorted(presence)
+    index = array(COLUMN_TYPECODE)
+    row = 0
+    for user_id in user_ids:
+        rows = len(presence[user_id].days)
+        index.extend((user_id, row, rows))
+        row += rows
+
+    header = json.dumps({
+        'byteorder': sys.byteorder,
+        'itemsize': index.itemsize,
+        'sources': sources,
+        'loader': dict(
+            loader_state,
+            tail=base64.b64encode(loader_state['tail']),
+        ),
+        'users': [
+            (user_id, user.get('name'), user.get('avatar'))
+            for user_id, user in sorted(users.iteritems())
+        ],
+        'user_count': len(user_ids),
+        'row_count': row,
+    })
+    header += ' ' * (-(PREAMBLE.size + len(header)) % ALIGNMENT)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            target.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            target.write(header)
+            index.tofile(target)
+            for name in UserPresence.COLUMNS:
+                for user_id in user_ids:
+                    getattr(presence[user_id], name).tofile(target)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def read_header(snapshot):
+    """
+    Reads preamble and header of open snapshot file, returns the header.
+    Raises ValueError when the file is not a snapshot of known version.
+    """
+    preamble = snapshot.read(PREAMBLE.size)
+    if len(preamble) != PREAMBLE.size:
+        raise ValueError('Truncated snapshot')
+    magic, version, header_size = PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise ValueError('Not a presence snapshot')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported snapshot version {0}'.format(version))
+
+    header = json.loads(snapshot.read(header_size))
+    header['loader']['tail'] = base64.b64decode(header['loader']['tail'])
+    return header
+
+
+def read_column(snapshot, header, size):
+    """
+    Reads array of 'size' items from open snapshot file.
+    """
+    column = array(COLUMN_TYPECODE)
+    if column.itemsize != header['itemsize']:
+        raise ValueError('Snapshot written with different item size')
+    column.fromfile(snapshot, size)
+    if header['byteorder'] != sys.byteorder:
+        column.byteswap()
+    return column
+
+
+def map_column(mapping, header, offset, size):
+    """
+    Returns read-only ctypes array of 'size' items at 'offset' of mapped
+    snapshot. Nothing is copied.
+    """
+    if ctypes.sizeof(MAPPED_TYPE) != header['itemsize']:
+        raise ValueError('Snapshot written with different item size')
+    return (MAPPED_TYPE * size).from_buffer(mapping, offset)
+
+
+def read_snapshot(path, shared=False):
+    """
+    Reads snapshot written by write_snapshot(). Returns header and
+    {user_id: UserPresence}. With 'shared' columns are mapped instead
+    of read, unless the snapshot was written with other byte order.
+    """
+    with open(path, 'rb') as snapshot:
+        header = read_header(snapshot)
+        index = read_column(snapshot, header, header['user_count'] * 3)
+        if shared and header['byteorder'] == sys.byteorder:
+            return header, map_presence(snapshot, header, index)
+        columns = [
+            read_column(snapshot, header, header['row_count'])
+            for __ in UserPresence.COLUMNS
+        ]
+
+    presence = {}
+    for i in xrange(0, len(index), 3):
+        user_id, first, rows = index[i:i + 3]
+        presence[user_id] = UserPresence.from_columns(*[
+            column[first:first + rows] for column in columns
+        ])
+    return header, presence
+
+
+def map_presence(snapshot, header, index):
+    """
+    Maps columns of open snapshot file positioned right after the index.
+    Returns {user_id: UserPresence}.
+    """
+    # copy-on-write mapping is writable as ctypes requires, pages which
+    # are only read stay shared with other processes
+    mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+    column_size = header['row_count'] * header['itemsize']
+    first_column = snapshot.tell()
+
+    presence = {}
+    for i in xrange(0, len(index), 3):
+        user_id, first, rows = index[i:i + 3]
+        presence[user_id] = UserPresence.from_columns(*[
+            map_column(
+                mapping,
+                header,
+                first_column + column * column_size +
+                first * header['itemsize'],
+                rows,
+            )
+            for column in xrange(len(UserPresence.COLUMNS))
+        ])
+    return presence
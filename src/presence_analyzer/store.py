@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented storage of presence data.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, time
+import heapq
+from itertools import islice, izip
+from operator import itemgetter
+from threading import Lock
+import os
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Every column is a C int, that is 32 bits on all supported platforms.
+COLUMN_TYPECODE = 'i'
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given date ordinal.
+    """
+    return (day - 1) % 7
+
+
+def year_month(day):
+    """
+    Encodes year and month of given date as single integer, e.g. 201309.
+    """
+    return day.year * 100 + day.month
+
+
+def format_year_month(value):
+    """
+    Formats year-month encoded by year_month() as 'YYYY-MM'.
+    """
+    return '{0}-{1:02}'.format(*divmod(value, 100))
+
+
+def seconds_since_midnight(value):
+    """
+    Calculates amount of seconds since midnight.
+    """
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def time_from_seconds(seconds):
+    """
+    Creates datetime.time object from amount of seconds since midnight.
+    """
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return time(hour, minute, second)
+
+
+class UserPresence(object):
+    """
+    Presence entries of a single user kept in parallel int32 columns:
+    date ordinals, year-months (see year_month()) and start/end times in
+    seconds since midnight. Rows are sorted by date once finalize() is
+    called, every date occurs at most once.
+
+    Supports read-only part of the mapping protocol used by the old
+    {date: {'start': time, 'end': time}} structure, so it can be used
+    wherever that dict was expected.
+    """
+    COLUMNS = ('days', 'months', 'starts', 'ends')
+    __slots__ = COLUMNS + ('_finalized', '_aggregates')
+
+    def __init__(self):
+        self.days = array(COLUMN_TYPECODE)
+        self.months = array(COLUMN_TYPECODE)
+        self.starts = array(COLUMN_TYPECODE)
+        self.ends = array(COLUMN_TYPECODE)
+        # amount of leading rows known to be sorted and unique
+        self._finalized = 0
+        self._aggregates = None
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Creates UserPresence from {date: {'start': time, 'end': time}}.
+        """
+        presence = cls()
+        for day, entry in items.iteritems():
+            presence.append(
+                day.toordinal(),
+                year_month(day),
+                seconds_since_midnight(entry['start']),
+                seconds_since_midnight(entry['end']),
+            )
+        presence.finalize()
+        return presence
+
+    @classmethod
+    def from_columns(cls, days, months, starts, ends):
+        """
+        Creates UserPresence from columns which are already sorted by date
+        without repeated dates, e.g. taken from another UserPresence.
+        Columns may be any sequences of ints, such as read-only views of a
+        memory mapped snapshot, rows are never appended to them.
+        """
+        presence = cls()
+        presence.days = days
+        presence.months = months
+        presence.starts = starts
+        presence.ends = ends
+        presence._finalized = len(days)
+        return presence
+
+    def append(self, day, month, start, end):
+        """
+        Appends single row. Call finalize() after the last one.
+        """
+        self.days.append(day)
+        self.months.append(month)
+        self.starts.append(start)
+        self.ends.append(end)
+        self._aggregates = None
+
+    def merge(self, other):
+        """
+        Returns new finalized UserPresence with rows of both objects. Rows
+        of 'other' win when both have the same date.
+        """
+        merged = UserPresence()
+        for name in self.COLUMNS:
+            # columns of either side may be read-only, see from_columns()
+            column = getattr(merged, name)
+            column.extend(getattr(self, name))
+            column.extend(getattr(other, name))
+        merged._finalized = self._finalized
+        merged.finalize()
+        return merged
+
+    def finalize(self):
+        """
+        Sorts rows by date. When the same date occurs more than once only
+        the last appended row is kept.
+        """
+        days = self.days
+        checked = max(self._finalized - 1, 0)
+        is_sorted = all(
+            previous < current
+            for previous, current in izip(
+                islice(days, checked, None),
+                islice(days, checked + 1, None),
+            )
+        )
+        self._finalized = len(days)
+        if is_sorted:
+            return
+
+        # sort is stable, so the last row of every date comes last
+        order = sorted(xrange(len(days)), key=days.__getitem__)
+        unique = [
+            index for index, following in izip(order, order[1:] + [None])
+            if following is None or days[following] != days[index]
+        ]
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(
+                self,
+                name,
+                array(COLUMN_TYPECODE, [column[i] for i in unique])
+            )
+        self._finalized = len(unique)
+        self._aggregates = None
+
+    @property
+    def aggregates(self):
+        """
+        PresenceAggregates of these rows, computed on first access.
+        """
+        if self._aggregates is None:
+            self._aggregates = PresenceAggregates(self)
+        return self._aggregates
+
+    def rows(self):
+        """
+        Iterates over (day, month, start, end) tuples in date order.
+        """
+        return izip(self.days, self.months, self.starts, self.ends)
+
+    def _index(self, day):
+        """
+        Returns position of given datetime.date or raises KeyError.
+        """
+        try:
+            ordinal = day.toordinal()
+        except AttributeError:
+            raise KeyError(day)
+        index = bisect_left(self.days, ordinal)
+        if index == len(self.days) or self.days[index] != ordinal:
+            raise KeyError(day)
+        return index
+
+    def __len__(self):
+        return len(self.days)
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.days)
+
+    def keys(self):
+        """
+        Returns list of dates in chronological order.
+        """
+        return list(self)
+
+    def __contains__(self, day):
+        try:
+            self._index(day)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, day):
+        index = self._index(day)
+        return {
+            'start': time_from_seconds(self.starts[index]),
+            'end': time_from_seconds(self.ends[index]),
+        }
+
+
+class PresenceAggregates(object):
+    """
+    Totals of a single user presence, so per-user statistics do not have
+    to walk all rows: amount of days, sum of presence time and sums of
+    start and end times for every weekday, and sum of presence time for
+    every year-month.
+    """
+    __slots__ = (
+        'weekday_counts',
+        'weekday_totals',
+        'weekday_starts',
+        'weekday_ends',
+        'month_totals',
+    )
+
+    def __init__(self, presence):
+        self.weekday_counts = counts = [0] * 7
+        self.weekday_totals = totals = [0] * 7
+        self.weekday_starts = starts = [0] * 7
+        self.weekday_ends = ends = [0] * 7
+        self.month_totals = month_totals = {}
+        for day, month, start, end in presence.rows():
+            day = weekday(day)
+            counts[day] += 1
+            totals[day] += end - start
+            starts[day] += start
+            ends[day] += end
+            month_totals[month] = month_totals.get(month, 0) + end - start
+
+    @staticmethod
+    def _mean(total, count):
+        """
+        Calculates arithmetic mean. Returns zero when there are no items.
+        """
+        return float(total) / count if count else 0
+
+    def mean_by_weekday(self):
+        """
+        Returns mean presence time for every weekday.
+        """
+        return [
+            self._mean(total, count)
+            for total, count in izip(self.weekday_totals, self.weekday_counts)
+        ]
+
+    def mean_start_end_by_weekday(self):
+        """
+        Returns [mean start, mean end] for every weekday.
+        """
+        return [
+            [self._mean(start, count), self._mean(end, count)]
+            for start, end, count in izip(
+                self.weekday_starts,
+                self.weekday_ends,
+                self.weekday_counts,
+            )
+        ]
+
+
+class PresenceData(dict):
+    """
+    Presence of all users, {user_id: UserPresence}, with indexes over all
+    of them built once by build_indexes() after the data is loaded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PresenceData, self).__init__(*args, **kwargs)
+        # year-month -> [(user_id, presence time)] ordered by user_id
+        self.month_index = {}
+        # [(year, month)] in chronological order
+        self.months = []
+        # months listing for the API, serialized by utils.get_data()
+        self.months_json = None
+        # version of source files, see utils.files_version()
+        self.version = None
+
+    def build_indexes(self):
+        """
+        Computes aggregates of every user, the month index and distinct
+        months.
+        """
+        month_index = {}
+        for user_id in sorted(self):
+            month_totals = self[user_id].aggregates.month_totals
+            for month, total in month_totals.iteritems():
+                month_index.setdefault(month, []).append((user_id, total))
+        self.month_index = month_index
+        self.months = [divmod(month, 100) for month in sorted(month_index)]
+
+    def top_in_month(self, year, month, limit):
+        """
+        Returns up to 'limit' (user_id, presence time) pairs with the most
+        presence in given month. Users who were not present at all fill the
+        result when there are too few of them, like with zero time.
+        """
+        totals = self.month_index.get(year * 100 + month, [])
+        result = heapq.nlargest(limit, totals, key=itemgetter(1))
+        if len(result) < limit:
+            present = set(user_id for user_id, total in totals)
+            absent = (
+                (user_id, 0) for user_id in sorted(self)
+                if user_id not in present
+            )
+            result.extend(islice(absent, limit - len(result)))
+        return result
+
+
+def as_user_presence(items):
+    """
+    Returns given presence entries as UserPresence, converting the legacy
+    dict structure if needed.
+    """
+    if isinstance(items, UserPresence):
+        return items
+    return UserPresence.from_items(items)
+
+
+class PresenceParser(object):
+    """
+    Parses presence CSV lines in 'user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS'
+    format into UserPresence columns.
+
+    Fields are sliced at their fixed positions instead of going through
+    datetime.strptime. Parsed dates and times are memoized, the same
+    values repeat over and over in a presence export. Fields which do not
+    match the fixed layout fall back to strptime.
+    """
+
+    def __init__(self):
+        self._dates = {}
+        self._times = {}
+
+    def parse_date(self, text):
+        """
+        Returns (date ordinal, year-month) of 'YYYY-MM-DD' string.
+        """
+        try:
+            return self._dates[text]
+        except KeyError:
+            pass
+
+        digits = text[:4] + text[5:7] + text[8:]
+        if len(text) == 10 and text[4] == text[7] == '-' and digits.isdigit():
+            day = date(int(text[:4]), int(text[5:7]), int(text[8:]))
+        else:
+            day = datetime.strptime(text, '%Y-%m-%d').date()
+        result = self._dates[text] = (day.toordinal(), year_month(day))
+        return result
+
+    def parse_time(self, text):
+        """
+        Returns seconds since midnight of 'HH:MM:SS' string.
+        """
+        try:
+            return self._times[text]
+        except KeyError:
+            pass
+
+        digits = text[:2] + text[3:5] + text[6:]
+        if len(text) == 8 and text[2] == text[5] == ':' and digits.isdigit():
+            hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:])
+            if hour > 23 or minute > 59 or second > 59:
+                raise ValueError('Invalid time: {0!r}'.format(text))
+        else:
+            value = datetime.strptime(text, '%H:%M:%S').time()
+            hour, minute, second = value.hour, value.minute, value.second
+        result = self._times[text] = hour * 3600 + minute * 60 + second
+        return result
+
+    def parse(self, lines, data, first_line=0):
+        """
+        Appends rows from given lines to {user_id: UserPresence} dict.
+        Lines which do not have exactly four fields (header, footer) are
+        skipped, malformed ones are logged. Returns set of ids of users
+        whose presence has changed, their UserPresence still has to be
+        finalized.
+        """
+        dates = self._dates
+        times = self._times
+        changed = set()
+        for i, line in enumerate(lines, first_line):
+            row = line.rstrip('\r\n').split(',')
+            if len(row) != 4:
+                # ignore header and footer lines
+                continue
+
+            # memoized values are looked up inline, it is the hot path
+            try:
+                user_id = int(row[0])
+                day, month = (
+                    dates[row[1]] if row[1] in dates
+                    else self.parse_date(row[1])
+                )
+                start = (
+                    times[row[2]] if row[2] in times
+                    else self.parse_time(row[2])
+                )
+                end = (
+                    times[row[3]] if row[3] in times
+                    else self.parse_time(row[3])
+                )
+            except (ValueError, TypeError):
+                log.debug('Problem with line %d: ', i, exc_info=True)
+                continue
+
+            try:
+                presence = data[user_id]
+            except KeyError:
+                presence = data[user_id] = UserPresence()
+            presence.append(day, month, start, end)
+            changed.add(user_id)
+
+        return changed
+
+
+def load_presence(path):
+    """
+    Reads whole presence CSV file. Returns {user_id: UserPresence}.
+    """
+    data = {}
+    with open(path, 'r') as csvfile:
+        PresenceParser().parse(csvfile, data)
+
+    for presence in data.itervalues():
+        presence.finalize()
+
+    return data
+
+
+class PresenceLoader(object):
+    """
+    Keeps presence data of an append-only CSV file up to date.
+
+    Remembers how far the file has been read together with its identity,
+    size and mtime. refresh() parses only the lines appended since the
+    previous call and falls back to reading the whole file again when it
+    was truncated or replaced. Data is never modified in place: changed
+    users get new UserPresence objects and a new dict is published, so
+    the result of previous refresh() stays consistent for its readers.
+    """
+    # amount of bytes before the offset used to detect rewritten files
+    TAIL_SIZE = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self._lock = Lock()
+        self._reset()
+
+    def _reset(self):
+        """
+        Forgets everything read so far.
+        """
+        self.data = {}
+        self.offset = 0
+        self.lines = 0
+        self._tail = ''
+        self._identity = None
+        self._size = None
+        self._mtime = None
+        self._parser = PresenceParser()
+
+    def state(self):
+        """
+        Returns what has been read so far, enough to restore() it later in
+        another process.
+        """
+        return {
+            'offset': self.offset,
+            'lines': self.lines,
+            'tail': self._tail,
+            'size': self._size,
+            'mtime': self._mtime,
+        }
+
+    def restore(self, state, data):
+        """
+        Continues from 'state' returned by state() and its {user_id:
+        UserPresence} data, which have to come from the same file.
+        """
+        with self._lock:
+            stat = os.stat(self.path)
+            self.data = data
+            self.offset = state['offset']
+            self.lines = state['lines']
+            self._tail = state['tail']
+            self._identity = (stat.st_dev, stat.st_ino)
+            self._size = state['size']
+            self._mtime = state['mtime']
+
+    def _is_appended(self, stat, csvfile):
+        """
+        Checks if the file still starts with the part read so far.
+        """
+        if (stat.st_dev, stat.st_ino) != self._identity:
+            return False
+        if stat.st_size < self.offset:
+            return False
+        csvfile.seek(self.offset - len(self._tail))
+        return csvfile.read(len(self._tail)) == self._tail
+
+    def _read_lines(self, csvfile, complete):
+        """
+        Yields lines from current offset to the end of file. Last line
+        without newline may be still being written, unless the file is
+        'complete', so it is not yielded and offset is left before it, it
+        will be read again by the next refresh.
+        """
+        csvfile.seek(self.offset)
+        for line in csvfile:
+            if not complete and not line.endswith('\n'):
+                break
+            yield line
+            self.offset += len(line)
+            self.lines += 1
+            self._tail = (self._tail + line)[-self.TAIL_SIZE:]
+
+    def refresh(self):
+        """
+        Reads new lines of the file. Returns {user_id: UserPresence}.
+
+        Last line without newline is read when the whole file is read, or
+        when the file has not changed since the previous refresh, as it is
+        most likely finished then.
+        """
+        with self._lock:
+            with open(self.path, 'rb') as csvfile:
+                stat = os.fstat(csvfile.fileno())
+                if not self._is_appended(stat, csvfile):
+                    if self._identity is not None:
+                        log.info('%s was replaced, reloading', self.path)
+                    self._reset()
+                unchanged = stat.st_size == self._size and \
+                    stat.st_mtime == self._mtime
+                if unchanged and stat.st_size == self.offset:
+                    return self.data
+                complete = unchanged or not self.offset
+
+                try:
+                    fresh = {}
+                    self._parser.parse(
+                        self._read_lines(csvfile, complete),
+                        fresh,
+                        self.lines,
+                    )
+                except Exception:
+                    self._reset()
+                    raise
+
+            data = dict(self.data)
+            for user_id, presence in fresh.iteritems():
+                if user_id in data:
+                    data[user_id] = data[user_id].merge(presence)
+                else:
+                    presence.finalize()
+                    data[user_id] = presence
+
+            self.data = data
+            self._identity = (stat.st_dev, stat.st_ino)
+            self._size = stat.st_size
+            self._mtime = stat.st_mtime
+            return data
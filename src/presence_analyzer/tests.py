@@ -4,13 +4,39 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 from flask import url_for
+import array
 import os
 import json
+import locale
+import shutil
+import signal
 import datetime
+import pstats
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 from urlparse import urlparse, parse_qs
-
-from presence_analyzer import forms, main, views, utils, models
+from StringIO import StringIO
+
+from passlib.context import CryptContext
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+
+from presence_analyzer import (
+    forms,
+    main,
+    metrics,
+    models,
+    passwords,
+    prefork,
+    profiling,
+    refresher,
+    store,
+    utils,
+    views,
+)
 
 
 TEST_DATA_CSV = os.path.join(
@@ -94,12 +120,14 @@ class PresenceAnalyzerViewsTestCase(PresenceAnalyzerTestCase):
         })
         self.client = main.app.test_client()
         utils.cached = {}
+        main.user_cache.clear()
 
     def tearDown(self):
         """
         Get rid of unused objects after each test.
         """
         utils.cached = {}
+        main.user_cache.clear()
 
     def login(self, username, password):
         """
@@ -427,6 +455,344 @@ class PresenceAnalyzerViewsTestCase(PresenceAnalyzerTestCase):
         ]
         self.assertEqual(json.loads(resp.data), sample_date)
 
+    def test_employees_in_year_month_limit(self):
+        """
+        Test 'limit' query parameter of top employees listing.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/top_employees/2013/9?limit=1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [user['id'] for user in json.loads(resp.data)],
+            [11]
+        )
+
+        resp = self.client.get('/api/v1/top_employees/2013/9?limit=0')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_users_returns_encoded_listing(self):
+        """
+        Test users listing is returned as serialized once per data load.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.data, utils.get_users_data().listing_json)
+
+    def test_api_months_returns_encoded_listing(self):
+        """
+        Test months listing is returned as serialized once per data load.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/months')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), [
+            {'year': 2011, 'month': 1, 'text': '2011-January'},
+            {'year': 2011, 'month': 2, 'text': '2011-February'},
+            {'year': 2013, 'month': 9, 'text': '2013-September'},
+        ])
+        self.assertEqual(resp.data, utils.get_data().months_json)
+
+    def test_api_conditional_get(self):
+        """
+        Test API responses carry ETag and honour If-None-Match.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+        self.assertIsNotNone(resp.last_modified)
+        etag = resp.headers['ETag']
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/11',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/top_employees/2013/9?limit=1',
+        )
+        self.assertNotEqual(
+            resp.headers['ETag'],
+            self.client.get('/api/v1/top_employees/2013/9').headers['ETag'],
+        )
+
+    def test_api_encoded_response_is_memoized(self):
+        """
+        Test encoded payload is reused for the same URL and data version.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        keys = [key for key in utils.cached if key.startswith('jsonify:')]
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(utils.cached[keys[0]], resp.data)
+
+        utils.cached[keys[0]] = utils.EncodedJSON('"memoized"')
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.data, '"memoized"')
+
+    def test_api_batch(self):
+        """
+        Test batch endpoint returns series of many users at once.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get(
+            '/api/v1/batch?users=10,0&series=presence_weekday'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(json.loads(resp.data), {
+            '10': {
+                'real_name': 'Jan P.',
+                'avatar': 'https://intranet.stxnext.pl/api/images/users/10',
+                'presence_weekday': json.loads(
+                    self.client.get('/api/v1/presence_weekday/10').data
+                ),
+            },
+            '0': None,
+        })
+
+        result = json.loads(self.client.get('/api/v1/batch?users=11').data)
+        self.assertItemsEqual(
+            result['11'],
+            ['real_name', 'avatar'] + list(views.SERIES),
+        )
+        self.assertEqual(
+            result['11']['start_end_weekday'],
+            json.loads(self.client.get('/api/v1/start_end_weekday/11').data),
+        )
+
+    def test_api_export(self):
+        """
+        Test export streams records of all users.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertTrue(resp.is_streamed)
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(
+            [record['user_id'] for record in records],
+            [10, 11, 12]
+        )
+        self.assertEqual(records[0], {
+            'user_id': 10,
+            'name': 'Jan P.',
+            'days': 3,
+            'presence_time': 78217,
+        })
+
+        resp = self.client.get('/api/v1/export?records=days&format=csv')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,date,start,end,presence_time')
+        self.assertEqual(lines[1], '10,2013-09-10,09:39:05,17:59:52,30047')
+        self.assertEqual(len(lines), 1 + sum(
+            len(presence) for presence in utils.get_data().itervalues()
+        ))
+
+        for url in [
+                '/api/v1/export?records=months',
+                '/api/v1/export?format=xml',
+        ]:
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_api_batch_400(self):
+        """
+        Test batch endpoint rejects invalid users and series.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        for url in [
+                '/api/v1/batch',
+                '/api/v1/batch?users=10,a',
+                '/api/v1/batch?users=10&series=presence_weekday,unknown',
+        ]:
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_api_batch_max_users(self):
+        """
+        Test batch endpoint rejects more than BATCH_MAX_USERS users.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        main.app.config['BATCH_MAX_USERS'] = 2
+        try:
+            resp = self.client.get('/api/v1/batch?users=10,11')
+            self.assertEqual(resp.status_code, 200)
+            resp = self.client.get('/api/v1/batch?users=10,11,12')
+            self.assertEqual(resp.status_code, 400)
+        finally:
+            del main.app.config['BATCH_MAX_USERS']
+        resp = self.client.get(
+            '/api/v1/batch?users=' + ','.join(['10'] * 101)
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def count_queries(self, url):
+        """
+        Requests 'url', returns amount of executed SQL statements.
+        """
+        statements = []
+
+        def before_execute(*args):
+            statements.append(args[2])
+
+        event.listen(main.db.engine, 'before_cursor_execute', before_execute)
+        try:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        finally:
+            event.remove(
+                main.db.engine, 'before_cursor_execute', before_execute
+            )
+        return len(statements)
+
+    def test_user_cache_avoids_queries(self):
+        """
+        Test logged user is loaded from database once.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        main.user_cache.clear()
+        self.assertGreater(self.count_queries('/api/v1/users'), 0)
+        self.assertEqual(self.count_queries('/api/v1/users'), 0)
+        self.assertEqual(self.count_queries('/presence_weekday'), 0)
+
+    def test_user_cache_ttl(self):
+        """
+        Test cached user expires and caching can be disabled.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        self.count_queries('/api/v1/users')
+        user_id, (expiry, values) = main.user_cache.items()[0]
+        self.assertEqual(values['username'], TEST_USER_USERNAME)
+        main.user_cache[user_id] = (time.time() - 1, values)
+        self.assertGreater(self.count_queries('/api/v1/users'), 0)
+        self.assertGreater(main.user_cache[user_id][0], time.time())
+
+        main.user_cache.clear()
+        main.app.config['USER_CACHE_TTL'] = 0
+        try:
+            self.assertGreater(self.count_queries('/api/v1/users'), 0)
+            self.assertGreater(self.count_queries('/api/v1/users'), 0)
+            self.assertEqual(main.user_cache, {})
+        finally:
+            del main.app.config['USER_CACHE_TTL']
+
+    def test_logout_and_register_forget_user(self):
+        """
+        Test logout and registration remove users from cache.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        self.count_queries('/api/v1/users')
+        self.assertEqual(len(main.user_cache), 1)
+        self.client.get('/user/logout/')
+        self.assertEqual(main.user_cache, {})
+
+        # id of removed user may be given to new one
+        next_id = main.db.session.query(
+            main.db.func.max(models.User.id)
+        ).scalar() + 1
+        main.user_cache[next_id] = (time.time() + 60, {})
+        self.client.post(
+            '/user/register/',
+            data=dict(username='cached', password='cached_password'),
+        )
+        self.assertEqual(
+            main.app.user_manager.find_user_by_username('cached').id,
+            next_id
+        )
+        self.assertEqual(main.user_cache, {})
+
+    def test_metrics_view(self):
+        """
+        Test requests, cache and data loading are reported at /metrics.
+        """
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        for metric in (
+                main.REQUESTS,
+                main.REQUEST_DURATION,
+                utils.CACHE_COMPUTE_DURATION,
+                utils.DATA_LOAD_DURATION,
+        ):
+            metric.clear()
+        utils.cache_stats.clear()
+        self.client.get('/api/v1/users')
+        self.client.get('/api/v1/users')
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/10')
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, metrics.CONTENT_TYPE)
+        lines = resp.data.splitlines()
+        self.assertIn(
+            'presence_analyzer_requests_total{endpoint="/api/v1/users",'
+            'method="GET",status="200"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_requests_total{endpoint='
+            '"/api/v1/mean_time_weekday/<int:user_id>",method="GET",'
+            'status="200"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_request_duration_seconds_count{endpoint='
+            '"/api/v1/users"} 2',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_data_load_seconds_count{source="files"} 1',
+            lines,
+        )
+        self.assertIn('# TYPE presence_analyzer_cache_events_total counter',
+                      lines)
+        # dataset and users are loaded once, dataset is hit by next
+        # requests, payload of the second mean_time_weekday is hit
+        self.assertIn(
+            'presence_analyzer_cache_events_total{event="hits"} 4',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_cache_events_total{event="misses"} 3',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_cache_compute_seconds_count{'
+            'function="load_dataset"} 1',
+            lines,
+        )
+        self.assertIn(
+            'presence_analyzer_cache_compute_seconds_count{'
+            'function="mean_time_weekday_view"} 1',
+            lines,
+        )
+
+    def test_metrics_view_access(self):
+        """
+        Test /metrics needs logging in, unless the address is allowed.
+        """
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        main.app.config['METRICS_ALLOWED_IPS'] = ('127.0.0.1', )
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+        finally:
+            del main.app.config['METRICS_ALLOWED_IPS']
+        self.login(TEST_USER_USERNAME, TEST_USER_PASSWORD)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -464,6 +830,291 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 39, 5)
         )
 
+    def test_dataset_is_pinned_for_request(self):
+        """
+        Test request keeps using dataset it has started with.
+        """
+        dataset = utils.get_dataset()
+        key = utils.compute_key(utils.load_dataset, (), {})
+        with main.app.test_request_context():
+            self.assertIs(utils.get_dataset(), dataset)
+            new_dataset = utils.Dataset(
+                store.PresenceData(),
+                utils.UsersData(),
+                dataset.version,
+            )
+            utils.cached[key] = dict(utils.cached[key], data=new_dataset)
+            self.assertIs(utils.get_data(), dataset.presence)
+            self.assertIs(utils.get_users_data(), dataset.users)
+        self.assertIs(utils.get_dataset(), new_dataset)
+
+    def test_dataset_loading_does_not_block_readers(self):
+        """
+        Test previous dataset is returned while another thread loads
+        changed files.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            shutil.copy(TEST_DATA_CSV, path)
+            main.app.config['DATA_CSV'] = path
+            dataset = utils.get_dataset()
+            with open(path, 'a') as csvfile:
+                csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+
+            # somebody else is loading it
+            key = utils.compute_key(utils.load_dataset, (), {})
+            utils.cache_locks.acquire(key)
+            try:
+                self.assertIs(utils.get_dataset(), dataset)
+            finally:
+                utils.cache_locks.release(key)
+            # loaded in background, previous one is returned meanwhile
+            self.assertIs(utils.get_dataset(), dataset)
+            for __ in range(500):
+                new_dataset = utils.get_dataset()
+                if new_dataset is not dataset:
+                    break
+                time.sleep(0.01)
+            self.assertIsNot(new_dataset, dataset)
+            self.assertIs(new_dataset.users, dataset.users)
+            self.assertEqual(
+                len(new_dataset.presence[10]),
+                len(dataset.presence[10]) + 1,
+            )
+        finally:
+            utils.presence_loaders.pop(path, None)
+            os.remove(path)
+
+    def test_get_users_data_is_cached_until_file_changes(self):
+        """
+        Test XML file is parsed again only after it has changed.
+        """
+        handle, path = tempfile.mkstemp(suffix='.xml')
+        os.close(handle)
+        try:
+            shutil.copy(TEST_DATA_XML, path)
+            main.app.config['DATA_XML'] = path
+            data = utils.get_users_data()
+            self.assertIs(utils.get_users_data(), data)
+            # reused when presence data is loaded again
+            utils.refresh_data()
+            self.assertIs(utils.get_users_data(), data)
+
+            with open(path, 'r+') as xmlfile:
+                content = xmlfile.read().replace(b'Jan P.', b'Jan Pe.')
+                xmlfile.seek(0)
+                xmlfile.write(content)
+            utils.refresh_data()
+            new_data = utils.get_users_data()
+            self.assertIsNot(new_data, data)
+            self.assertEqual(new_data[10]['name'], 'Jan Pe.')
+        finally:
+            os.remove(path)
+
+    def test_snapshot(self):
+        """
+        Test data is loaded from snapshot of current data files only.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            main.app.config.update({
+                'DATA_CSV': os.path.join(directory, 'data.csv'),
+                'DATA_XML': os.path.join(directory, 'users.xml'),
+                'DATA_SNAPSHOT': os.path.join(directory, 'snapshot.bin'),
+            })
+            shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+            shutil.copy(TEST_DATA_XML, main.app.config['DATA_XML'])
+            self.assertFalse(utils.load_snapshot())
+
+            utils.save_snapshot()
+            self.assertTrue(utils.load_snapshot())
+            self.assertEqual(
+                utils.get_presence_loader().offset,
+                os.path.getsize(TEST_DATA_CSV),
+            )
+            data = utils.get_data()
+            expected = store.load_presence(TEST_DATA_CSV)
+            self.assertItemsEqual(data, [10, 11, 12])
+            for user_id in data:
+                self.assertEqual(list(data[user_id].rows()),
+                                 list(expected[user_id].rows()))
+            self.assertEqual(utils.get_users_data(),
+                             utils.load_users(TEST_DATA_XML))
+            self.assertEqual(
+                utils.get_users_data().listing_json,
+                utils.load_users(TEST_DATA_XML).listing_json,
+            )
+
+            with open(main.app.config['DATA_CSV'], 'r+') as csvfile:
+                csvfile.write('11')
+            self.assertFalse(utils.load_snapshot())
+
+            with open(main.app.config['DATA_SNAPSHOT'], 'r+b') as snapshot:
+                snapshot.write('broken')
+            self.assertFalse(utils.load_snapshot())
+        finally:
+            del main.app.config['DATA_SNAPSHOT']
+            utils.presence_loaders.clear()
+            utils.preloaded_users.clear()
+            shutil.rmtree(directory)
+
+    def test_snapshot_append_after_save(self):
+        """
+        Test snapshot is still loaded after lines are appended to the CSV
+        file, and only the appended lines are parsed.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            main.app.config.update({
+                'DATA_CSV': os.path.join(directory, 'data.csv'),
+                'DATA_XML': os.path.join(directory, 'users.xml'),
+                'DATA_SNAPSHOT': os.path.join(directory, 'snapshot.bin'),
+            })
+            shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+            shutil.copy(TEST_DATA_XML, main.app.config['DATA_XML'])
+            utils.save_snapshot()
+            with open(main.app.config['DATA_CSV'], 'a') as csvfile:
+                csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+
+            self.assertTrue(utils.load_snapshot())
+            loader = utils.get_presence_loader()
+            lines = loader.lines
+            self.assertEqual(loader.offset, os.path.getsize(TEST_DATA_CSV))
+            data = utils.reload_data().presence
+            self.assertEqual(loader.lines, lines + 1)
+            self.assertEqual(
+                loader.offset,
+                os.path.getsize(main.app.config['DATA_CSV']),
+            )
+            expected = store.load_presence(main.app.config['DATA_CSV'])
+            self.assertEqual(len(data[10]), 4)
+            for user_id in data:
+                self.assertEqual(list(data[user_id].rows()),
+                                 list(expected[user_id].rows()))
+        finally:
+            del main.app.config['DATA_SNAPSHOT']
+            utils.presence_loaders.clear()
+            utils.preloaded_users.clear()
+            shutil.rmtree(directory)
+
+    def test_snapshot_append_during_save(self):
+        """
+        Test lines appended while snapshot is saved are left out of it and
+        parsed after it is loaded.
+        """
+        directory = tempfile.mkdtemp()
+        load_users = utils.load_users
+
+        def append_and_load_users(path):
+            """
+            Appends a line to the CSV file after it has been parsed.
+            """
+            with open(main.app.config['DATA_CSV'], 'a') as csvfile:
+                csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+            return load_users(path)
+
+        try:
+            main.app.config.update({
+                'DATA_CSV': os.path.join(directory, 'data.csv'),
+                'DATA_XML': os.path.join(directory, 'users.xml'),
+                'DATA_SNAPSHOT': os.path.join(directory, 'snapshot.bin'),
+            })
+            shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+            shutil.copy(TEST_DATA_XML, main.app.config['DATA_XML'])
+            utils.load_users = append_and_load_users
+            try:
+                utils.save_snapshot()
+            finally:
+                utils.load_users = load_users
+
+            self.assertTrue(utils.load_snapshot())
+            loader = utils.get_presence_loader()
+            self.assertEqual(loader.offset, os.path.getsize(TEST_DATA_CSV))
+            data = utils.reload_data().presence
+            self.assertEqual(
+                loader.offset,
+                os.path.getsize(main.app.config['DATA_CSV']),
+            )
+            self.assertEqual(len(data[10]), 4)
+        finally:
+            del main.app.config['DATA_SNAPSHOT']
+            utils.presence_loaders.clear()
+            utils.preloaded_users.clear()
+            shutil.rmtree(directory)
+
+    def test_shared_snapshot(self):
+        """
+        Test memory mapped snapshot is shared and lines appended later are
+        still merged.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            main.app.config.update({
+                'DATA_CSV': os.path.join(directory, 'data.csv'),
+                'DATA_XML': os.path.join(directory, 'users.xml'),
+                'DATA_SNAPSHOT': os.path.join(directory, 'snapshot.bin'),
+                'DATA_SNAPSHOT_SHARED': True,
+            })
+            shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+            shutil.copy(TEST_DATA_XML, main.app.config['DATA_XML'])
+            utils.save_snapshot()
+            self.assertTrue(utils.load_snapshot())
+
+            data = utils.get_data()
+            expected = store.load_presence(TEST_DATA_CSV)
+            self.assertNotIsInstance(data[10].days, array.array)
+            for user_id in data:
+                self.assertEqual(list(data[user_id].rows()),
+                                 list(expected[user_id].rows()))
+            self.assertEqual(
+                data[10].aggregates.weekday_totals,
+                expected[10].aggregates.weekday_totals,
+            )
+
+            with open(main.app.config['DATA_CSV'], 'a') as csvfile:
+                csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+            data = utils.get_presence_loader().refresh()
+            self.assertEqual(len(data[10]), len(expected[10]) + 1)
+            self.assertEqual(
+                data[10][datetime.date(2013, 9, 13)]['end'],
+                datetime.time(17, 0, 0),
+            )
+        finally:
+            del main.app.config['DATA_SNAPSHOT']
+            del main.app.config['DATA_SNAPSHOT_SHARED']
+            utils.presence_loaders.clear()
+            utils.preloaded_users.clear()
+            shutil.rmtree(directory)
+
+    def test_load_users(self):
+        """
+        Test streaming parser of users XML file.
+        """
+        data = utils.load_users(TEST_DATA_XML)
+        self.assertItemsEqual(data.keys(), [10, 11, 12, 13])
+        self.assertEqual(
+            data[13],
+            {
+                'avatar': 'https://intranet.stxnext.pl/api/images/users/13',
+                'name': 'Łukasz K.',
+            }
+        )
+
+    def test_users_listing(self):
+        """
+        Test users listing is serialized sorted by collation key.
+        """
+        data = utils.load_users(TEST_DATA_XML)
+        self.assertIsInstance(data.listing_json, utils.EncodedJSON)
+        listing = json.loads(data.listing_json)
+        names = [user['name'] for user in listing]
+        self.assertEqual(names, sorted(names, cmp=locale.strcoll))
+        self.assertItemsEqual(
+            [user['user_id'] for user in listing],
+            [10, 11, 12, 13]
+        )
+
     def test_get_months(self):
         """
         Test result of get_moths().
@@ -557,6 +1208,325 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             }
         )
 
+    def test_cache_uses_arguments(self):
+        """
+        Test cache stores results separately for every set of arguments.
+        """
+        calls = []
+
+        @utils.cache(600)
+        def square(value):
+            """
+            Squares value and records the call.
+            """
+            calls.append(value)
+            return value * value
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square(value=2), 4)
+        self.assertEqual(calls, [2, 3, 2])
+
+    def test_cache_refresh(self):
+        """
+        Test refresh replaces cached result right away.
+        """
+        calls = []
+
+        @utils.cache(600)
+        def square(value):
+            """
+            Squares value and records the call.
+            """
+            calls.append(value)
+            return value * value
+
+        self.assertEqual(square(2), 4)
+        self.assertEqual(square.refresh(2), 4)
+        self.assertEqual(square(2), 4)
+        self.assertEqual(calls, [2, 2])
+
+    def test_cache_depends_on(self):
+        """
+        Test result becomes obsolete when a file it depends on changes.
+        """
+        calls = []
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        main.app.config['CACHE_TEST_FILE'] = path
+
+        @utils.cache(depends_on=('CACHE_TEST_FILE', ))
+        def counter():
+            """
+            Returns number of calls.
+            """
+            calls.append(None)
+            return len(calls)
+
+        try:
+            self.assertEqual(counter(), 1)
+            self.assertEqual(counter(), 1)
+            with open(path, 'w') as testfile:
+                testfile.write('changed')
+            self.assertEqual(counter(), 2)
+            self.assertEqual(counter(), 2)
+        finally:
+            del main.app.config['CACHE_TEST_FILE']
+            os.remove(path)
+
+    def test_cache_single_flight(self):
+        """
+        Test only one thread computes missing result, others wait for it.
+        """
+        calls = []
+        started = threading.Event()
+
+        @utils.cache(600)
+        def slow():
+            """
+            Takes a while to compute.
+            """
+            calls.append(None)
+            started.set()
+            time.sleep(0.1)
+            return len(calls)
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(slow()))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [1] * 5)
+
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test obsolete result is returned and recomputed in background.
+        """
+        calls = []
+
+        @utils.cache(600, stale_while_revalidate=True)
+        def counter():
+            """
+            Returns number of calls.
+            """
+            calls.append(None)
+            return len(calls)
+
+        self.assertEqual(counter(), 1)
+        key = utils.compute_key(counter, (), {})
+        utils.cached[key]['datetime'] -= datetime.timedelta(seconds=601)
+        self.assertEqual(counter(), 1)
+        # wait for the background thread to store new result
+        for i in range(500):
+            if utils.cached[key]['data'] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(counter(), 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_store_evicts_least_recently_used(self):
+        """
+        Test CacheStore keeps at most CACHE_MAX_ENTRIES entries and evicts
+        least recently used ones.
+        """
+        main.app.config['CACHE_MAX_ENTRIES'] = 2
+        try:
+            entries = utils.CacheStore()
+            entries['a'] = 1
+            entries['b'] = 2
+            self.assertEqual(entries.get('a'), 1)
+            entries['c'] = 3
+            self.assertEqual(len(entries), 2)
+            self.assertIsNone(entries.get('b'))
+            self.assertEqual(entries['a'], 1)
+            self.assertEqual(entries['c'], 3)
+        finally:
+            del main.app.config['CACHE_MAX_ENTRIES']
+
+    def test_cache_store_limits_size(self):
+        """
+        Test CacheStore keeps estimated size of entries below
+        CACHE_MAX_BYTES.
+        """
+        entries = utils.CacheStore()
+        entries['a'] = 'x' * 1000
+        entries['b'] = 'x' * 1000
+        size = entries.sizes()['a']
+        self.assertGreater(size, 1000)
+        self.assertEqual(entries.bytes, 2 * size)
+
+        main.app.config['CACHE_MAX_BYTES'] = size * 3 / 2
+        try:
+            entries['c'] = 'x' * 1000
+            self.assertEqual(entries.sizes().keys(), ['c'])
+            self.assertEqual(entries.bytes, size)
+        finally:
+            del main.app.config['CACHE_MAX_BYTES']
+
+    def test_cache_store_expires_entries(self):
+        """
+        Test CacheStore drops entries older than CACHE_TTL and counts it.
+        """
+        utils.cache_stats.clear()
+        entries = utils.CacheStore()
+        entries['a'] = 1
+        main.app.config['CACHE_TTL'] = 0
+        try:
+            time.sleep(0.01)
+            self.assertIsNone(entries.get('a'))
+            self.assertEqual(len(entries), 0)
+            self.assertEqual(utils.cache_stats['expirations'], 1)
+        finally:
+            del main.app.config['CACHE_TTL']
+
+    def test_cache_single_flight_survives_eviction(self):
+        """
+        Test key stays locked while its entry is evicted, so that only one
+        thread computes it.
+        """
+        utils.cached = utils.CacheStore()
+        calls = []
+        started = threading.Event()
+        proceed = threading.Event()
+
+        @utils.cache(600)
+        def slow():
+            """
+            Waits until the test lets it finish.
+            """
+            calls.append(None)
+            started.set()
+            proceed.wait(5)
+            return len(calls)
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(slow()))
+        first.start()
+        started.wait(5)
+        main.app.config['CACHE_MAX_ENTRIES'] = 1
+        try:
+            utils.cached[utils.compute_key(slow, (), {})] = None
+            utils.cached['other'] = 1
+            second = threading.Thread(target=lambda: results.append(slow()))
+            second.start()
+            time.sleep(0.05)
+            proceed.set()
+            first.join()
+            second.join()
+        finally:
+            del main.app.config['CACHE_MAX_ENTRIES']
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [1, 1])
+        self.assertEqual(len(utils.cache_locks), 0)
+
+    def test_cache_store_contains(self):
+        """
+        Test membership check neither marks entry as used nor expires it.
+        """
+        main.app.config['CACHE_MAX_ENTRIES'] = 2
+        try:
+            entries = utils.CacheStore()
+            entries['a'] = 1
+            entries['b'] = 2
+            self.assertIn('a', entries)
+            entries['c'] = 3
+            self.assertNotIn('a', entries)
+            self.assertIn('b', entries)
+
+            main.app.config['CACHE_TTL'] = 0
+            time.sleep(0.01)
+            self.assertIn('b', entries)
+            self.assertEqual(len(entries), 2)
+        finally:
+            del main.app.config['CACHE_MAX_ENTRIES']
+            main.app.config.pop('CACHE_TTL', None)
+
+    def test_cache_info(self):
+        """
+        Test cache counters and memory usage.
+        """
+        utils.cache_stats.clear()
+        utils.cached = utils.CacheStore()
+        utils.cached['answer'] = 42
+        utils.count_cache_event('misses')
+        utils.count_cache_event('hits')
+        info = utils.cache_info()
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['entries'], 1)
+        self.assertGreater(info['bytes'], 0)
+
+    def test_jsonify_single_flight(self):
+        """
+        Test only one thread encodes missing payload, others wait for it.
+        """
+        utils.cached = utils.CacheStore()
+        calls = []
+        started = threading.Event()
+        proceed = threading.Event()
+
+        @utils.jsonify
+        def slow():
+            """
+            Waits until the test lets it finish.
+            """
+            calls.append(None)
+            started.set()
+            proceed.wait(5)
+            return {'calls': len(calls)}
+
+        def request():
+            """
+            Calls view in its own request context.
+            """
+            with main.app.test_request_context('/slow'):
+                results.append(slow().data)
+
+        results = []
+        threads = [threading.Thread(target=request) for i in range(3)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        proceed.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['{"calls": 1}'] * 3)
+        self.assertEqual(len(utils.cache_locks), 0)
+
+    def test_get_json_encoder(self):
+        """
+        Test selecting JSON encoder by app config.
+        """
+        self.assertIs(utils.get_json_encoder(), json.dumps)
+        self.assertEqual(utils.encode_json({'a': [1]}), '{"a": [1]}')
+
+        main.app.config['JSON_ENCODER'] = 'pickle'
+        try:
+            with self.assertRaises(ValueError):
+                utils.get_json_encoder()
+        finally:
+            del main.app.config['JSON_ENCODER']
+
+    def test_estimate_size(self):
+        """
+        Test estimating memory used by presence data.
+        """
+        small = utils.estimate_size({10: store.UserPresence()})
+        data = store.load_presence(TEST_DATA_CSV)
+        self.assertGreater(utils.estimate_size(data), small)
+
     def test_seconds_since_midnight(self):
         """
         Test calculating seconds since midnight.
@@ -658,6 +1628,1049 @@ class PresenceAnalyzerFormsTestCase(PresenceAnalyzerTestCase):
         )
 
 
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.presence = store.UserPresence()
+        for day, start, end in [
+                (datetime.date(2016, 10, 20), 34200, 63900),
+                (datetime.date(2016, 10, 17), 28800, 57600),
+                (datetime.date(2016, 10, 20), 30000, 60000),
+        ]:
+            self.presence.append(
+                day.toordinal(),
+                store.year_month(day),
+                start,
+                end,
+            )
+        self.presence.finalize()
+
+    def test_finalize_sorts_and_keeps_last_entry(self):
+        """
+        Test finalize() sorts rows by date and keeps the last row of
+        duplicated dates.
+        """
+        self.assertEqual(
+            list(self.presence.days),
+            [
+                datetime.date(2016, 10, 17).toordinal(),
+                datetime.date(2016, 10, 20).toordinal(),
+            ]
+        )
+        self.assertEqual(list(self.presence.months), [201610, 201610])
+        self.assertEqual(list(self.presence.starts), [28800, 30000])
+        self.assertEqual(list(self.presence.ends), [57600, 60000])
+
+    def test_mapping_access(self):
+        """
+        Test UserPresence can be read like {date: {'start', 'end'}} dict.
+        """
+        self.assertEqual(len(self.presence), 2)
+        self.assertIn(datetime.date(2016, 10, 17), self.presence)
+        self.assertNotIn(datetime.date(2016, 10, 18), self.presence)
+        self.assertEqual(
+            self.presence[datetime.date(2016, 10, 20)],
+            {
+                'start': datetime.time(8, 20, 0),
+                'end': datetime.time(16, 40, 0),
+            }
+        )
+        self.assertEqual(
+            self.presence.keys(),
+            [datetime.date(2016, 10, 17), datetime.date(2016, 10, 20)]
+        )
+        with self.assertRaises(KeyError):
+            self.presence[datetime.date(2016, 10, 18)]
+
+    def test_aggregates(self):
+        """
+        Test per weekday and per month totals of user presence.
+        """
+        aggregates = self.presence.aggregates
+        self.assertIs(self.presence.aggregates, aggregates)
+        self.assertEqual(aggregates.weekday_counts, [1, 0, 0, 1, 0, 0, 0])
+        self.assertEqual(
+            aggregates.weekday_totals,
+            [28800, 0, 0, 30000, 0, 0, 0]
+        )
+        self.assertEqual(aggregates.month_totals, {201610: 58800})
+        self.assertEqual(
+            aggregates.mean_by_weekday(),
+            [28800.0, 0, 0, 30000.0, 0, 0, 0]
+        )
+        self.assertEqual(
+            aggregates.mean_start_end_by_weekday(),
+            [
+                [28800.0, 57600.0],
+                [0, 0],
+                [0, 0],
+                [30000.0, 60000.0],
+                [0, 0],
+                [0, 0],
+                [0, 0],
+            ]
+        )
+
+        day = datetime.date(2016, 11, 1)
+        self.presence.append(day.toordinal(), 201611, 30000, 33600)
+        self.assertIsNot(self.presence.aggregates, aggregates)
+        self.assertEqual(
+            self.presence.aggregates.month_totals,
+            {201610: 58800, 201611: 3600}
+        )
+
+    def test_top_in_month(self):
+        """
+        Test selecting users with the most presence in month.
+        """
+        data = store.PresenceData(store.load_presence(TEST_DATA_CSV))
+        data.build_indexes()
+        self.assertEqual(data.month_index[201102], [(12, 3600)])
+        self.assertEqual(
+            data.top_in_month(2013, 9, 2),
+            [(11, 118402), (10, 78217)]
+        )
+        self.assertEqual(
+            data.top_in_month(2013, 9, 5),
+            [(11, 118402), (10, 78217), (12, 0), (14, 0)]
+        )
+        self.assertEqual(data.top_in_month(2012, 1, 2), [(10, 0), (11, 0)])
+
+    def test_months(self):
+        """
+        Test distinct months of all users.
+        """
+        data = store.PresenceData(store.load_presence(TEST_DATA_CSV))
+        data.build_indexes()
+        self.assertEqual(
+            data.months,
+            [(2011, 1), (2011, 2), (2013, 4), (2013, 9)]
+        )
+
+    def test_weekday(self):
+        """
+        Test weekday of date ordinal.
+        """
+        for day in range(17, 24):
+            date = datetime.date(2016, 10, day)
+            self.assertEqual(store.weekday(date.toordinal()), date.weekday())
+
+    def test_parser(self):
+        """
+        Test parsing presence lines. Header, footer and malformed lines are
+        skipped, fields which are not zero padded are accepted.
+        """
+        data = {}
+        lines = [
+            'user_id,date,start,end\r\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-9-11,9:19:52,16:07:37\r\n',
+            '11,2013-09-31,09:00:00,17:00:00\r\n',
+            '11,2013-09-30,25:00:00,17:00:00\r\n',
+            'x,2013-09-30,09:00:00,17:00:00\r\n',
+            '\r\n',
+        ]
+        changed = store.PresenceParser().parse(lines, data)
+        self.assertEqual(changed, set([10]))
+        self.assertEqual(data.keys(), [10])
+        self.assertEqual(list(data[10].starts), [34745, 33592])
+        self.assertEqual(list(data[10].ends), [64792, 58057])
+        self.assertEqual(list(data[10].months), [201309, 201309])
+
+    def test_load_presence(self):
+        """
+        Test loading whole presence file.
+        """
+        data = store.load_presence(TEST_DATA_CSV)
+        self.assertItemsEqual(data.keys(), [10, 11, 12, 14])
+        self.assertEqual(
+            data[10].keys(),
+            [
+                datetime.date(2013, 9, 10),
+                datetime.date(2013, 9, 11),
+                datetime.date(2013, 9, 12),
+            ]
+        )
+
+    def test_loader_reads_appended_lines(self):
+        """
+        Test PresenceLoader parses only lines appended since last refresh,
+        including a line which was partially written before.
+        """
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, 'w') as csvfile:
+                csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+            loader = store.PresenceLoader(path)
+            data = loader.refresh()
+            self.assertIs(loader.refresh(), data)
+
+            with open(path, 'a') as csvfile:
+                csvfile.write('10,2013-09-11,09:00:00,1')
+            data = loader.refresh()
+            self.assertEqual(list(data[10].ends), [61200])
+            self.assertEqual(loader.offset, 32)
+            self.assertEqual(loader.lines, 1)
+
+            with open(path, 'a') as csvfile:
+                csvfile.write(
+                    '6:00:00\n'
+                    '11,2013-09-10,10:00:00,12:00:00\n'
+                )
+            new_data = loader.refresh()
+            self.assertEqual(list(new_data[10].ends), [61200, 57600])
+            self.assertEqual(list(new_data[11].starts), [36000])
+            self.assertEqual(loader.offset, 96)
+            self.assertEqual(loader.lines, 3)
+            # previous result is left untouched
+            self.assertEqual(list(data[10].ends), [61200])
+            self.assertNotIn(11, data)
+        finally:
+            os.remove(path)
+
+    def test_loader_skips_partial_line(self):
+        """
+        Test PresenceLoader does not parse a partially written line which
+        looks valid, until it is completed.
+        """
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, 'w') as csvfile:
+                csvfile.write('10,2013-09-10,09:00:00,17:00:00\n')
+            loader = store.PresenceLoader(path)
+            loader.refresh()
+            with open(path, 'a') as csvfile:
+                csvfile.write('10,2013-09-11,09:00:00,17:59:5')
+            data = loader.refresh()
+            self.assertEqual(len(data[10]), 1)
+            self.assertEqual(loader.offset, 32)
+            self.assertEqual(loader.lines, 1)
+
+            with open(path, 'a') as csvfile:
+                csvfile.write('9\n')
+            data = loader.refresh()
+            self.assertEqual(list(data[10].ends), [61200, 64799])
+            self.assertEqual(loader.offset, 64)
+            self.assertEqual(loader.lines, 2)
+        finally:
+            os.remove(path)
+
+    def test_loader_reads_last_line_without_newline(self):
+        """
+        Test last line without newline is read with the whole file, and
+        when the file has not changed since the previous refresh.
+        """
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    '10,2013-09-10,09:00:00,17:00:00\n'
+                    '10,2013-09-11,09:00:00,16:00:00'
+                )
+            self.assertEqual(len(store.load_presence(path)[10]), 2)
+            loader = store.PresenceLoader(path)
+            self.assertEqual(len(loader.refresh()[10]), 2)
+            self.assertEqual(loader.offset, os.path.getsize(path))
+
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n10,2013-09-12,09:00:00,15:00:00')
+            self.assertEqual(len(loader.refresh()[10]), 2)
+            data = loader.refresh()
+            self.assertEqual(list(data[10].ends), [61200, 57600, 54000])
+            self.assertIs(loader.refresh(), data)
+        finally:
+            os.remove(path)
+
+    def test_loader_reloads_rewritten_file(self):
+        """
+        Test PresenceLoader reads whole file again when it was truncated or
+        replaced.
+        """
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    '10,2013-09-10,09:00:00,17:00:00\n'
+                    '10,2013-09-11,09:00:00,16:00:00\n'
+                )
+            loader = store.PresenceLoader(path)
+            self.assertEqual(len(loader.refresh()[10]), 2)
+
+            with open(path, 'w') as csvfile:
+                csvfile.write('11,2013-09-10,09:00:00,17:00:00\n')
+            self.assertEqual(loader.refresh().keys(), [11])
+
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    '12,2013-09-10,09:00:00,17:00:00\n'
+                    '12,2013-09-11,09:00:00,17:00:00\n'
+                )
+            self.assertEqual(loader.refresh().keys(), [12])
+            self.assertEqual(len(loader.data[12]), 2)
+        finally:
+            os.remove(path)
+
+    def test_time_from_seconds(self):
+        """
+        Test creating datetime.time from seconds since midnight.
+        """
+        self.assertEqual(
+            store.time_from_seconds(44115),
+            datetime.time(12, 15, 15)
+        )
+
+
+class PresenceAnalyzerRefresherTestCase(unittest.TestCase):
+    """
+    Background refresher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up copies of data files.
+        """
+        self.directory = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': os.path.join(self.directory, 'data.csv'),
+            'DATA_XML': os.path.join(self.directory, 'users.xml'),
+        })
+        shutil.copy(TEST_DATA_CSV, main.app.config['DATA_CSV'])
+        shutil.copy(TEST_DATA_XML, main.app.config['DATA_XML'])
+        utils.cached = {}
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.cached = {}
+        utils.presence_loaders.clear()
+        shutil.rmtree(self.directory)
+
+    def append_presence(self):
+        """
+        Appends presence of user 10 on 2013-09-13.
+        """
+        with open(main.app.config['DATA_CSV'], 'a') as csvfile:
+            csvfile.write('10,2013-09-13,09:00:00,17:00:00\n')
+
+    def test_check_calls_callback_on_change(self):
+        """
+        Test callback is called only after data files change.
+        """
+        calls = []
+        thread = refresher.DataRefresher(
+            utils.PRESENCE_FILES,
+            lambda: calls.append(1),
+            60,
+        )
+        thread.check()
+        self.assertEqual(calls, [])
+
+        self.append_presence()
+        thread.check()
+        thread.check()
+        self.assertEqual(calls, [1])
+
+    def test_refresh_data(self):
+        """
+        Test refreshed data replaces cached one.
+        """
+        data = utils.get_data()
+        self.append_presence()
+        new_data = utils.refresh_data().presence
+        self.assertIsNot(new_data, data)
+        self.assertIs(utils.get_data(), new_data)
+        self.assertEqual(len(new_data[10]), len(data[10]) + 1)
+
+    def test_refresher_thread(self):
+        """
+        Test running refresher notices changes.
+        """
+        thread = refresher.DataRefresher(utils.PRESENCE_FILES, None, 0.05)
+        refreshed = threading.Event()
+        thread.callback = refreshed.set
+        thread.start()
+        try:
+            self.append_presence()
+            self.assertTrue(refreshed.wait(5))
+        finally:
+            thread.stop()
+            thread.join()
+
+    def test_inotify_watcher(self):
+        """
+        Test inotify watcher wakes up on change.
+        """
+        try:
+            watcher = refresher.InotifyWatcher([main.app.config['DATA_CSV']])
+        except OSError:
+            self.skipTest('inotify is not available')
+        try:
+            self.append_presence()
+            started = time.time()
+            watcher.wait(5)
+            self.assertLess(time.time() - started, 1)
+        finally:
+            watcher.close()
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start arbiter with two workers.
+        """
+        self.check_interval = prefork.CHECK_INTERVAL
+        prefork.CHECK_INTERVAL = 0.1
+        self.directory = tempfile.mkdtemp()
+        self.reloaded = os.path.join(self.directory, 'reloaded')
+
+        def app(environ, start_response):
+            """
+            Responds with pid of worker.
+            """
+            start_response(b'200 OK', [(b'Content-Type', b'text/plain')])
+            return [str(os.getpid())]
+
+        arbiter = prefork.Arbiter(
+            app,
+            '127.0.0.1',
+            0,
+            2,
+            max_requests=2,
+            on_reload=lambda: open(self.reloaded, 'w').close(),
+        )
+        self.url = 'http://127.0.0.1:{0}/'.format(arbiter.server.port)
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                arbiter.run()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        arbiter.server.server_close()
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    def tearDown(self):
+        """
+        Stop arbiter after each test.
+        """
+        prefork.CHECK_INTERVAL = self.check_interval
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        shutil.rmtree(self.directory)
+
+    def get_pids(self, requests):
+        """
+        Returns set of pids of workers which served requests.
+        """
+        return set(
+            self.opener.open(self.url, timeout=10).read()
+            for __ in xrange(requests)
+        )
+
+    def test_workers_are_recycled(self):
+        """
+        Test requests are served by workers, which are replaced after
+        serving 'max_requests' requests.
+        """
+        pids = self.get_pids(8)
+        self.assertNotIn(str(self.pid), pids)
+        self.assertGreaterEqual(len(pids), 4)
+
+    def test_reload_replaces_workers(self):
+        """
+        Test HUP reloads data and starts new workers.
+        """
+        def is_running(pid):
+            """
+            Checks if process exists.
+            """
+            try:
+                os.kill(int(pid), 0)
+            except OSError:
+                return False
+            return True
+
+        old_pids = self.get_pids(1)
+        os.kill(self.pid, signal.SIGHUP)
+        deadline = time.time() + 10
+        while time.time() < deadline and (
+                not os.path.exists(self.reloaded) or
+                any(is_running(pid) for pid in old_pids)
+        ):
+            time.sleep(0.05)
+        self.assertTrue(os.path.exists(self.reloaded))
+        self.assertFalse(self.get_pids(4) & old_pids)
+
+    def test_stop(self):
+        """
+        Test TERM stops arbiter and workers.
+        """
+        self.get_pids(1)
+        os.kill(self.pid, signal.SIGTERM)
+        pid, status = os.waitpid(self.pid, 0)
+        self.pid = None
+        self.assertEqual(status, 0)
+        with self.assertRaises(urllib2.URLError):
+            self.opener.open(self.url, timeout=10)
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+    """
+    Database engine configuration tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, creates temporary directory.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Removes temporary directory.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_pool_options(self):
+        """
+        Test connection pool options built from config.
+        """
+        self.assertEqual(main.pool_options({}, False), {})
+        self.assertEqual(
+            main.pool_options({'DATABASE_POOL_SIZE': 0}, False),
+            {'poolclass': main.NullPool},
+        )
+        self.assertEqual(
+            main.pool_options(
+                {
+                    'DATABASE_POOL_SIZE': 5,
+                    'DATABASE_POOL_MAX_OVERFLOW': 2,
+                    'DATABASE_POOL_PRE_PING': True,
+                },
+                False,
+            ),
+            {
+                'poolclass': main.QueuePool,
+                'pool_size': 5,
+                'max_overflow': 2,
+                'pool_timeout': 30,
+                'pool_pre_ping': True,
+            },
+        )
+        options = main.pool_options(
+            {'DATABASE_POOL_SIZE': 50, 'DATABASE_POOL_PER_THREAD': True},
+            True,
+        )
+        self.assertEqual(options['poolclass'], main.SingletonThreadPool)
+        self.assertEqual(options['pool_size'], 50)
+        self.assertEqual(
+            options['connect_args'],
+            {'check_same_thread': False},
+        )
+
+    def test_sqlite_pragmas(self):
+        """
+        Test pragmas are applied to new SQLite connections.
+        """
+        config = {
+            'DATABASE_POOL_SIZE': 2,
+            'DATABASE_BUSY_TIMEOUT': 1234,
+            'DATABASE_JOURNAL_MODE': 'WAL',
+            'DATABASE_SYNCHRONOUS': 'NORMAL',
+        }
+        self.assertEqual(
+            main.sqlite_pragmas(config),
+            [
+                'PRAGMA busy_timeout = 1234',
+                'PRAGMA journal_mode = WAL',
+                'PRAGMA synchronous = NORMAL',
+            ],
+        )
+        self.assertEqual(main.sqlite_pragmas({}), [])
+
+        previous = dict(main.app.config)
+        main.app.config.update(config)
+        try:
+            engine = main.db.create_engine(
+                make_url(
+                    'sqlite:///' + os.path.join(self.directory, 'db.sqlite')
+                ),
+                {},
+            )
+        finally:
+            main.app.config.clear()
+            main.app.config.update(previous)
+        try:
+            self.assertIsInstance(engine.pool, main.QueuePool)
+            connection = engine.connect()
+            self.assertEqual(
+                connection.execute('PRAGMA journal_mode').scalar(),
+                'wal',
+            )
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(),
+                1234,
+            )
+            # NORMAL
+            self.assertEqual(
+                connection.execute('PRAGMA synchronous').scalar(),
+                1,
+            )
+            connection.close()
+        finally:
+            engine.dispose()
+
+    def create_engine(self, url):
+        """
+        Creates engine of url with pool of size 2 and busy timeout.
+        """
+        previous = dict(main.app.config)
+        main.app.config.update({
+            'DATABASE_POOL_SIZE': 2,
+            'DATABASE_BUSY_TIMEOUT': 1234,
+        })
+        try:
+            return main.db.create_engine(make_url(url), {})
+        finally:
+            main.app.config.clear()
+            main.app.config.update(previous)
+
+    def test_sqlite_driver_name(self):
+        """
+        Test SQLite is recognized by backend name, with driver given too.
+        """
+        engine = self.create_engine(
+            'sqlite+pysqlite:///' + os.path.join(self.directory, 'db.sqlite')
+        )
+        try:
+            self.assertIsInstance(engine.pool, main.QueuePool)
+            connection = engine.connect()
+            self.assertEqual(
+                connection.execute('PRAGMA busy_timeout').scalar(),
+                1234,
+            )
+            connection.close()
+        finally:
+            engine.dispose()
+
+    def test_sqlite_in_memory(self):
+        """
+        Test in-memory SQLite database is kept by one shared connection,
+        even with pool configured.
+        """
+        for url in ('sqlite://', 'sqlite+pysqlite:///:memory:'):
+            engine = self.create_engine(url)
+            try:
+                self.assertIsInstance(engine.pool, main.StaticPool)
+                engine.execute('CREATE TABLE kept (id INTEGER)')
+                thread = threading.Thread(
+                    target=engine.execute,
+                    args=('INSERT INTO kept VALUES (1)', ),
+                )
+                thread.start()
+                thread.join()
+                self.assertEqual(
+                    engine.execute('SELECT COUNT(*) FROM kept').scalar(),
+                    1,
+                )
+            finally:
+                engine.dispose()
+
+
+class PresenceAnalyzerPasswordsTestCase(PresenceAnalyzerTestCase):
+    """
+    Password workers tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, enables one password worker and hashing.
+        """
+        self.user_manager = main.app.user_manager
+        self.previous = (
+            self.user_manager.password_hash,
+            self.user_manager.password_crypt_context,
+        )
+        self.user_manager.password_hash = 'sha256_crypt'
+        self.user_manager.password_crypt_context = CryptContext(
+            schemes=['sha256_crypt'],
+            sha256_crypt__default_rounds=1000,
+        )
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'PASSWORD_WORKERS': 1,
+        })
+        passwords.start_pool()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Stops workers, restores plaintext passwords.
+        """
+        passwords.close_pool()
+        for key in (
+                'PASSWORD_WORKERS',
+                'PASSWORD_QUEUE_LIMIT',
+                'PASSWORD_TIMEOUT',
+        ):
+            main.app.config.pop(key, None)
+        (
+            self.user_manager.password_hash,
+            self.user_manager.password_crypt_context,
+        ) = self.previous
+
+    def test_run(self):
+        """
+        Test functions are run by worker process when workers are enabled.
+        """
+        self.assertNotEqual(passwords.run(os.getpid), os.getpid())
+        with self.assertRaises(ValueError):
+            passwords.run(int, 'x')
+        self.assertEqual(passwords.pending, 0)
+        main.app.config['PASSWORD_WORKERS'] = 0
+        self.assertEqual(passwords.run(os.getpid), os.getpid())
+
+    def test_run_without_pool(self):
+        """
+        Test functions are run by calling thread until pool is started, it
+        is not started on demand.
+        """
+        passwords.close_pool()
+        self.assertEqual(passwords.run(os.getpid), os.getpid())
+        self.assertIsNone(passwords.pool)
+
+    def test_timeout(self):
+        """
+        Test password which timed out is not pending anymore, and is
+        skipped by workers when they have not taken it yet.
+        """
+        main.app.config['PASSWORD_TIMEOUT'] = 0.05
+        with self.assertRaises(passwords.PasswordWorkersBusy):
+            passwords.run(time.sleep, 0.5)
+        with self.assertRaises(passwords.PasswordWorkersBusy):
+            passwords.run(time.sleep, 5)
+        self.assertEqual(passwords.pending, 0)
+        main.app.config['PASSWORD_TIMEOUT'] = 2
+        self.assertNotEqual(passwords.run(os.getpid), os.getpid())
+
+    def test_killed_worker(self):
+        """
+        Test password of killed worker is not pending anymore, and another
+        worker takes its place.
+        """
+        main.app.config['PASSWORD_TIMEOUT'] = 1
+        errors = []
+
+        def run():
+            """
+            Waits for password of worker which gets killed.
+            """
+            try:
+                passwords.run(time.sleep, 5)
+            except passwords.PasswordWorkersBusy as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(passwords.pending, 1)
+        os.kill(passwords.pool._pool[0].pid, signal.SIGKILL)
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(passwords.pending, 0)
+        self.assertNotEqual(passwords.run(os.getpid), os.getpid())
+
+    def test_hash_and_verify_password(self):
+        """
+        Test passwords hashed by workers are verified by Flask-User and
+        the other way round.
+        """
+        hashed = passwords.hash_password('secret')
+        self.assertTrue(hashed.startswith('$5$'))
+        user = models.User(username='hashed', password=hashed)
+        self.assertTrue(self.user_manager.verify_password('secret', user))
+
+        user.password = self.user_manager.hash_password('secret')
+        self.assertTrue(passwords.verify_password('secret', user))
+        self.assertFalse(passwords.verify_password('wrong', user))
+
+    def test_register_and_login(self):
+        """
+        Test registered user can log in with hashing done by workers.
+        """
+        resp = self.client.post(
+            '/user/register/',
+            data=dict(username='hashed', password='hashed_password'),
+        )
+        self.assertEqual(resp.status_code, 302)
+        user = self.user_manager.find_user_by_username('hashed')
+        self.assertNotEqual(user.password, 'hashed_password')
+
+        resp = self.client.post(
+            '/user/login/',
+            data=dict(username='hashed', password='hashed_password'),
+        )
+        self.assertEqual(resp.status_code, 302)
+
+    def test_busy_workers_return_503(self):
+        """
+        Test login is refused right away when too many passwords wait for
+        workers.
+        """
+        main.app.config['PASSWORD_QUEUE_LIMIT'] = 3
+        passwords.pending = 3
+        resp = self.client.post(
+            '/user/login/',
+            data=dict(
+                username=TEST_USER_USERNAME,
+                password=TEST_USER_PASSWORD,
+            ),
+        )
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(passwords.pending, 3)
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, hides metrics of the application.
+        """
+        self.registry = metrics.registry
+        metrics.registry = []
+
+    def tearDown(self):
+        """
+        Restores metrics of the application.
+        """
+        metrics.registry = self.registry
+
+    def test_counter_sums_threads(self):
+        """
+        Test values recorded by threads are summed up, also after the
+        threads have finished.
+        """
+        counter = metrics.Counter('test_total', 'Test.', ('kind', ))
+
+        def record():
+            counter.inc('a')
+            counter.inc('b', amount=2)
+
+        threads = [threading.Thread(target=record) for __ in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('a')
+        self.assertEqual(counter.collect(), {('a', ): 4, ('b', ): 6})
+        # finished threads are merged, and still counted
+        self.assertEqual(len(counter._shards), 1)
+        self.assertEqual(counter.collect(), {('a', ): 4, ('b', ): 6})
+
+        counter.clear()
+        self.assertEqual(counter.collect(), {})
+
+    def test_metric_sums_threads(self):
+        """
+        Test values of untyped metric are summed up like counters.
+        """
+        metric = metrics.Metric('test', 'Test.', ('kind', ))
+        metric.values()[('a', )] = 2
+        thread = threading.Thread(
+            target=lambda: metric.values().update({('a', ): 3, ('b', ): 1})
+        )
+        thread.start()
+        thread.join()
+        self.assertEqual(metric.collect(), {('a', ): 5, ('b', ): 1})
+
+    def test_histogram(self):
+        """
+        Test histogram counts observations in buckets.
+        """
+        histogram = metrics.Histogram('test', 'Test.', (), (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.collect(), {(): ((2, 3), 14.5, 4)})
+
+    def test_render(self):
+        """
+        Test metrics are rendered in Prometheus text format.
+        """
+        counter = metrics.Counter('test_total', 'Test "counter".', ('path', ))
+        counter.inc('/a"\\')
+        histogram = metrics.Histogram('test_seconds', 'Test.', (), (0.5, ))
+        histogram.observe(0.25)
+        metrics.Callback('test_size', 'Test.', (), lambda: {(): 3})
+        self.assertEqual(
+            metrics.render(),
+            '# HELP test_total Test "counter".\n'
+            '# TYPE test_total counter\n'
+            'test_total{path="/a\\"\\\\"} 1\n'
+            '# HELP test_seconds Test.\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="0.5"} 1\n'
+            'test_seconds_bucket{le="+Inf"} 1\n'
+            'test_seconds_sum 0.25\n'
+            'test_seconds_count 1\n'
+            '# HELP test_size Test.\n'
+            '# TYPE test_size gauge\n'
+            'test_size 3\n'
+        )
+
+
+class PresenceAnalyzerProfilingTestCase(unittest.TestCase):
+    """
+    Profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, saves profiles of all requests in temporary
+        directory.
+        """
+        self.directory = tempfile.mkdtemp()
+        main.app.config.update({
+            'PROFILE_DIR': self.directory,
+            'PROFILE_SAMPLE_RATE': 1,
+            'PROFILE_THRESHOLD': 0,
+            'PROFILE_SECRET': 'secret',
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Removes temporary directory and disables profiling.
+        """
+        shutil.rmtree(self.directory)
+        for key in (
+                'PROFILE_DIR',
+                'PROFILE_SAMPLE_RATE',
+                'PROFILE_THRESHOLD',
+                'PROFILE_SECRET',
+                'PROFILE_MAX_FILES',
+        ):
+            main.app.config.pop(key, None)
+
+    def test_slow_requests_are_saved(self):
+        """
+        Test profiles of sampled requests over threshold are saved.
+        """
+        self.client.get('/metrics')
+        names = os.listdir(self.directory)
+        self.assertEqual(len(names), 1)
+        parsed = profiling.FILE_NAME.match(names[0])
+        self.assertEqual(parsed.group('path'), 'metrics')
+        stats = pstats.Stats(os.path.join(self.directory, names[0]))
+        self.assertIn(
+            'metrics_view',
+            [function for __, __, function in stats.stats],
+        )
+
+        main.app.config['PROFILE_THRESHOLD'] = 60
+        self.client.get('/metrics')
+        main.app.config.update({
+            'PROFILE_THRESHOLD': 0,
+            'PROFILE_SAMPLE_RATE': 0,
+        })
+        self.client.get('/metrics')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        main.app.config.update({
+            'PROFILE_SAMPLE_RATE': 1,
+            'PROFILE_MAX_FILES': 1,
+        })
+        self.client.get('/metrics')
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_profile_header(self):
+        """
+        Test requests with secret header are always profiled and saved.
+        """
+        main.app.config.update({
+            'PROFILE_THRESHOLD': 60,
+            'PROFILE_SAMPLE_RATE': 0,
+        })
+        self.client.get('/metrics', headers={'X-Profile': 'wrong'})
+        self.assertEqual(os.listdir(self.directory), [])
+        self.client.get('/metrics', headers={'X-Profile': 'secret'})
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        main.app.config['PROFILE_SECRET'] = None
+        self.client.get('/metrics', headers={'X-Profile': 'None'})
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_summarize(self):
+        """
+        Test summary lists profiles and merged statistics.
+        """
+        output = StringIO()
+        self.assertEqual(profiling.summarize(self.directory, stream=output), 0)
+        self.assertIn('No profiles', output.getvalue())
+
+        self.client.get('/metrics')
+        self.client.get('/metrics')
+        self.client.get('/not/found')
+        output = StringIO()
+        self.assertEqual(
+            profiling.summarize(self.directory, limit=5, stream=output),
+            3,
+        )
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0].split()[-1], 'path')
+        self.assertEqual(
+            sorted((line.split()[0], line.split()[-1]) for line in lines[1:3]),
+            [('1', 'not_found'), ('2', 'metrics')],
+        )
+        self.assertIn('function calls', output.getvalue())
+
+        output = StringIO()
+        self.assertEqual(
+            profiling.summarize(
+                self.directory,
+                match='not_found',
+                stream=output,
+            ),
+            1,
+        )
+        # statistics may mention any function, only summary rows are checked
+        lines = output.getvalue().splitlines()
+        fields = lines[1].split()
+        self.assertEqual((fields[0], fields[-1]), ('1', 'not_found'))
+        self.assertEqual(lines[2], '')
+
+    def test_summarize_missing_directory(self):
+        """
+        Test summary of directory which has not been created yet.
+        """
+        directory = os.path.join(self.directory, 'missing')
+        output = StringIO()
+        self.assertEqual(profiling.summarize(directory, stream=output), 0)
+        self.assertEqual(
+            output.getvalue(),
+            'No profiles in {0}\n'.format(directory),
+        )
+
+
 def suite():
     """
     Default test suite.
@@ -666,6 +2679,13 @@ def suite():
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerFormsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerRefresherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPasswordsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilingTestCase))
     return base_suite
 
 
@@ -3,126 +3,676 @@
 Helper functions used in views.
 """
 
-from collections import defaultdict
-import csv
+from collections import Counter, OrderedDict, defaultdict
+import calendar
 from json import dumps
 from functools import wraps
-from datetime import datetime, timedelta
-from threading import Lock
+from itertools import chain, izip
+from datetime import date, datetime, timedelta
+from threading import Lock, Thread
 from copy import deepcopy
+from cStringIO import StringIO
+import csv
 import hashlib
+import locale
+import os
 import pickle
+import sys
+import time
+from timeit import default_timer
 
-from flask import Response
+from flask import Response, g, has_request_context, request
 from lxml import etree
 
 from presence_analyzer.main import app
+from presence_analyzer.metrics import LATENCY_BUCKETS, Callback, Histogram
+from presence_analyzer.store import (
+    PresenceData,
+    PresenceLoader,
+    UserPresence,
+    as_user_presence,
+    format_year_month,
+    seconds_since_midnight,
+    time_from_seconds,
+    weekday,
+)
+from presence_analyzer.snapshot import (
+    is_appended,
+    is_current,
+    prefix_info,
+    read_snapshot,
+    source_info,
+    write_snapshot,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+class EncodedJSON(str):
+    """
+    Already serialized JSON document, jsonify() sends it as it is.
+    """
+
+
+# modules providing dumps(), selected with JSON_ENCODER app config key
+JSON_ENCODERS = ('json', 'simplejson', 'ujson')
+json_encoders = {}
+
+
+def get_json_encoder():
+    """
+    Returns dumps() function of the JSON_ENCODER module, stdlib json by
+    default. Falls back to stdlib json when the module is not installed.
+    """
+    name = app.config.get('JSON_ENCODER', 'json')
+    if name not in json_encoders:
+        if name not in JSON_ENCODERS:
+            raise ValueError('Unknown JSON encoder: {0}'.format(name))
+        try:
+            module = __import__(name)
+        except ImportError:
+            log.warning('JSON encoder %s is not installed, using json', name)
+            json_encoders[name] = dumps
+        else:
+            json_encoders[name] = module.dumps
+    return json_encoders[name]
+
+
+def encode_json(value):
+    """
+    Serializes value with the configured JSON encoder.
+    """
+    return EncodedJSON(get_json_encoder()(value))
+
+
+def data_version():
+    """
+    Returns versions of currently loaded presence and users data, and time
+    of the most recent modification of their source files.
+    """
+    versions = (get_data().version, get_users_data().version)
+    modified = [
+        stat[3]
+        for version in versions
+        for stat in version
+        if stat is not None
+    ]
+    return versions, max(modified) if modified else None
+
+
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Response has ETag computed from version of loaded data and requested URL,
+    when client already has it the function is not called at all and 304 Not
+    Modified is returned. Encoded results are kept in the cache under the
+    same key, so identical payloads are serialized once per data version,
+    by one thread while others asking for the same one wait for it.
     """
+    def compute(key, args, kwargs):
+        """
+        Calls wrapped function and stores its encoded result in cache.
+        Results which the function has encoded itself are not stored.
+        """
+        started = default_timer()
+        result = function(*args, **kwargs)
+        if not isinstance(result, EncodedJSON):
+            result = encode_json(result)
+            cached[key] = result
+            count_cache_event('misses')
+            CACHE_COMPUTE_DURATION.observe(
+                default_timer() - started,
+                function.__name__,
+            )
+        return result
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        versions, modified = data_version()
+        etag = hashlib.sha1(repr((versions, request.full_path))).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            key = 'jsonify:{0}:{1}'.format(
+                app.config.get('JSON_ENCODER', 'json'),
+                etag,
+            )
+            result = cached.get(key)
+            if result is None:
+                cache_locks.acquire(key)
+                try:
+                    result = cached.get(key)
+                    if result is None:
+                        result = compute(key, args, kwargs)
+                    else:
+                        count_cache_event('hits')
+                finally:
+                    cache_locks.release(key)
+            else:
+                count_cache_event('hits')
+            response = Response(result, mimetype='application/json')
+
+        response.set_etag(etag)
+        if modified is not None:
+            response.last_modified = datetime.utcfromtimestamp(modified)
+        response.headers['Cache-Control'] = app.config.get(
+            'API_CACHE_CONTROL',
+            'private, no-cache',
         )
+        return response
     return inner
 
 
-cached = {}
+def estimate_size(value, seen=None):
+    """
+    Estimates memory used by value and everything it references, in bytes.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(key, seen) + estimate_size(item, seen)
+            for key, item in value.iteritems()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    elif isinstance(value, UserPresence):
+        size += sum(
+            estimate_size(getattr(value, name), seen)
+            for name in value.COLUMNS
+        )
+    return size
+
+
+class CacheStore(object):
+    """
+    Dict-like storage of cache entries. Keeps at most CACHE_MAX_ENTRIES
+    entries of CACHE_MAX_BYTES estimated size in total, evicting least
+    recently used ones first. Entries stored more than CACHE_TTL seconds
+    ago are dropped. Limits are read from app config, missing ones are
+    not enforced.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # neither marks entry as used nor expires it
+        with self._lock:
+            return key in self._entries
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Returns value stored under key and marks it as recently used.
+        """
+        with self._lock:
+            try:
+                stored, size, value = self._entries.pop(key)
+            except KeyError:
+                return default
+
+            ttl = app.config.get('CACHE_TTL')
+            if ttl is not None and time.time() - stored > ttl:
+                self.bytes -= size
+                count_cache_event('expirations')
+                return default
+
+            self._entries[key] = (stored, size, value)
+            return value
+
+    def __setitem__(self, key, value):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (time.time(), size, value)
+            self.bytes += size
+
+            max_entries = app.config.get('CACHE_MAX_ENTRIES')
+            max_bytes = app.config.get('CACHE_MAX_BYTES')
+            # the newest entry is never evicted, even if it is too big
+            while len(self._entries) > 1 and (
+                    max_entries is not None and
+                    len(self._entries) > max_entries or
+                    max_bytes is not None and self.bytes > max_bytes
+            ):
+                evicted, (stored, size, value) = self._entries.popitem(
+                    last=False
+                )
+                self.bytes -= size
+                count_cache_event('evictions')
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def sizes(self):
+        """
+        Returns {key: estimated size in bytes} of stored entries.
+        """
+        with self._lock:
+            return {
+                key: size
+                for key, (stored, size, value) in self._entries.iteritems()
+            }
+
+
+class KeyLocks(object):
+    """
+    Locks of cache keys. Lock of a key exists as long as some thread holds
+    or waits for it, independently of the cache entry, so that eviction or
+    expiration never lets two threads compute the same key at once.
+    """
+
+    def __init__(self):
+        # key -> (lock, amount of threads holding or waiting for it)
+        self._locks = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._locks)
+
+    def acquire(self, key, blocking=True):
+        """
+        Acquires lock of key. Returns False when it is held by another
+        thread and 'blocking' is False.
+        """
+        with self._lock:
+            lock, users = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = Lock()
+            self._locks[key] = (lock, users + 1)
+        if lock.acquire(blocking):
+            return True
+        self._forget(key)
+        return False
+
+    def release(self, key):
+        """
+        Releases lock of key, it may be released by another thread than
+        the one which has acquired it.
+        """
+        with self._lock:
+            lock = self._locks[key][0]
+        lock.release()
+        self._forget(key)
+
+    def _forget(self, key):
+        """
+        Drops lock of key when nobody uses it anymore.
+        """
+        with self._lock:
+            lock, users = self._locks[key]
+            if users > 1:
+                self._locks[key] = (lock, users - 1)
+            else:
+                del self._locks[key]
+
+
+cache_locks = KeyLocks()
+cache_stats = Counter()
+cache_stats_lock = Lock()
+cached = CacheStore()
+
+
+def count_cache_event(name):
+    """
+    Increments one of cache_stats counters: hits, stale, misses,
+    evictions or expirations.
+    """
+    with cache_stats_lock:
+        cache_stats[name] += 1
+
+
+def cache_info():
+    """
+    Returns cache counters and memory usage.
+    """
+    with cache_stats_lock:
+        info = dict(cache_stats)
+    info.update(
+        entries=len(cached),
+        bytes=getattr(cached, 'bytes', None),
+    )
+    return info
+
+
+def cache_events():
+    """
+    Returns cache counters as {(event, ): count}.
+    """
+    with cache_stats_lock:
+        return {(name, ): count for name, count in cache_stats.iteritems()}
+
+
+def cache_usage(name):
+    """
+    Returns {(): value} of 'entries' or 'bytes' from cache_info().
+    """
+    value = cache_info()[name]
+    return {} if value is None else {(): value}
+
+
+CACHE_EVENTS = Callback(
+    'presence_analyzer_cache_events_total',
+    'Cache hits, stale hits, misses, evictions and expirations.',
+    ('event', ),
+    cache_events,
+    kind='counter',
+)
+CACHE_ENTRIES = Callback(
+    'presence_analyzer_cache_entries',
+    'Entries stored in cache.',
+    (),
+    lambda: cache_usage('entries'),
+)
+CACHE_BYTES = Callback(
+    'presence_analyzer_cache_bytes',
+    'Estimated size of entries stored in cache.',
+    (),
+    lambda: cache_usage('bytes'),
+)
+CACHE_COMPUTE_DURATION = Histogram(
+    'presence_analyzer_cache_compute_seconds',
+    'Time spent computing results of cached functions and API payloads.',
+    ('function', ),
+    LATENCY_BUCKETS,
+)
+DATA_LOAD_DURATION = Histogram(
+    'presence_analyzer_data_load_seconds',
+    'Time spent loading presence and users data from data files or '
+    'snapshot.',
+    ('source', ),
+    LATENCY_BUCKETS,
+)
 
 
 def compute_key(function, args, kwargs):
-    key = pickle.dumps((function.func_name, args, kwargs))
+    """
+    Computes cache key of function called with given arguments.
+    """
+    key = pickle.dumps(
+        (function.__module__, function.func_name, args, sorted(kwargs.items()))
+    )
     return hashlib.sha1(key).hexdigest()
 
 
-def cache(seconds):
+def files_version(config_keys):
+    """
+    Returns device, inode, size and mtime of files whose paths are stored
+    under given app config keys. Missing files are represented by None.
+    """
+    version = []
+    for config_key in config_keys:
+        try:
+            stat = os.stat(app.config[config_key])
+        except OSError:
+            version.append(None)
+        else:
+            version.append(
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+            )
+    return tuple(version)
+
+
+def cache(seconds=None, stale_while_revalidate=False, depends_on=()):
     """
     Cache result of function for the time specified by 'seconds' parametr.
+
+    Results are cached separately for every set of arguments. Only one
+    thread computes missing or obsolete result, other threads asking for
+    the same key wait for it. With 'stale_while_revalidate' obsolete
+    result is returned right away and recomputed in a background thread.
+
+    'depends_on' lists app config keys of files the result is computed
+    from. Result becomes obsolete as soon as any of them changes, with
+    'seconds' set to None that is the only way it expires.
+
+    Decorated function's 'refresh' attribute computes the result right
+    away and replaces the cached one.
     """
     def wrapper(function):
+        def is_obsolete(entry):
+            """
+            Checks if cache entry is older than 'seconds' or any of files
+            it depends on has changed.
+            """
+            if seconds is not None and (
+                    datetime.now() - entry['datetime'] >
+                    timedelta(seconds=seconds)
+            ):
+                return True
+            return entry['version'] != files_version(depends_on)
+
+        def compute(key, args, kwargs):
+            """
+            Calls wrapped function and stores its result in cache.
+            """
+            # version is taken first, changes made during computation
+            # will be picked up by the next call
+            version = files_version(depends_on)
+            started = default_timer()
+            data = function(*args, **kwargs)
+            CACHE_COMPUTE_DURATION.observe(
+                default_timer() - started,
+                function.func_name,
+            )
+            cached[key] = {
+                'datetime': datetime.now(),
+                'version': version,
+                'data': data,
+            }
+            return data
+
+        def revalidate(key, args, kwargs):
+            """
+            Recomputes obsolete entry, releases lock of key afterwards.
+            """
+            try:
+                entry = cached.get(key)
+                if entry is None or is_obsolete(entry):
+                    compute(key, args, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', function.func_name)
+            finally:
+                cache_locks.release(key)
+
         @wraps(function)
         def inner(*args, **kwargs):
             """
             This docstring will be overridden by @wraps decorator.
             """
-            with Lock():
-                key = compute_key(function, args, kwargs)
-                if key in cached:
-                    cache_is_obsolete = (
-                        datetime.now() - cached[key]['datetime'] >
-                        timedelta(seconds=seconds)
+            key = compute_key(function, args, kwargs)
+            entry = cached.get(key)
+            if entry is not None and not is_obsolete(entry):
+                count_cache_event('hits')
+                return entry['data']
+
+            if entry is not None and stale_while_revalidate:
+                count_cache_event('stale')
+                if cache_locks.acquire(key, False):
+                    thread = Thread(
+                        target=revalidate,
+                        args=(key, args, kwargs),
                     )
-                    if not cache_is_obsolete:
-                        return cached[key]['data']
-                cached[key] = {
-                    'datetime': datetime.now(),
-                    'data': function(),
-                }
-                return cached[key]['data']
+                    thread.daemon = True
+                    thread.start()
+                return entry['data']
+
+            cache_locks.acquire(key)
+            try:
+                entry = cached.get(key)
+                if entry is not None and not is_obsolete(entry):
+                    count_cache_event('hits')
+                    return entry['data']
+                count_cache_event('misses')
+                return compute(key, args, kwargs)
+            finally:
+                cache_locks.release(key)
+
+        def refresh(*args, **kwargs):
+            """
+            Computes result again right away and replaces cached one,
+            readers get the old result until then.
+            """
+            key = compute_key(function, args, kwargs)
+            cache_locks.acquire(key)
+            try:
+                return compute(key, args, kwargs)
+            finally:
+                cache_locks.release(key)
+
+        inner.refresh = refresh
         return inner
     return wrapper
 
 
-@cache(600)
+# app config keys of files presence and users data are loaded from
+PRESENCE_FILES = ('DATA_CSV', 'DATA_XML')
+USERS_FILES = ('DATA_XML', )
+
+presence_loaders = {}
+# users read from snapshot, taken by load_users_data()
+preloaded_users = {}
+
+
+def get_presence_loader():
+    """
+    Returns PresenceLoader of the current DATA_CSV file. Loader remembers
+    what has already been read, so only new lines are parsed on refresh.
+    """
+    path = app.config['DATA_CSV']
+    if path not in presence_loaders:
+        presence_loaders.setdefault(path, PresenceLoader(path))
+    return presence_loaders[path]
+
+
+class Dataset(object):
+    """
+    Presence data, users and indexes over them loaded together from given
+    version of data files, see files_version(). Never modified once it is
+    cached, so it can be read without locking.
+    """
+    __slots__ = ('presence', 'users', 'version')
+
+    def __init__(self, presence, users, version):
+        self.presence = presence
+        self.users = users
+        self.version = version
+
+
+@cache(depends_on=USERS_FILES)
+def load_users_data():
+    """
+    Returns users from DATA_XML, or from DATA_SNAPSHOT when it has been
+    loaded. Result is cached until the file changes, so users are reused
+    by datasets loaded after only DATA_CSV has changed.
+    """
+    version = files_version(USERS_FILES)
+    users = preloaded_users.pop(app.config['DATA_XML'], None)
+    if users is None or users.version != version:
+        users = load_users(app.config['DATA_XML'])
+        users.version = version
+    return users
+
+
+@cache(stale_while_revalidate=True, depends_on=PRESENCE_FILES)
+def load_dataset():
+    """
+    Loads Dataset from data files. Result is cached until any of them
+    changes, then the previous Dataset is still returned while a background
+    thread loads the new one.
+    """
+    started = default_timer()
+    version = files_version(PRESENCE_FILES)
+    users = load_users_data()
+    presence = PresenceData(
+        (user_id, user_presence)
+        for user_id, user_presence
+        in get_presence_loader().refresh().iteritems()
+        if user_id in users
+    )
+    # indexes are built here, so that requests do not pay for it
+    presence.version = version
+    presence.build_indexes()
+    presence.months_json = encode_json([
+        {'year': year, 'month': month, 'text': month_text(year, month)}
+        for year, month in presence.months
+    ])
+    DATA_LOAD_DURATION.observe(default_timer() - started, 'files')
+    return Dataset(presence, users, version)
+
+
+def get_dataset():
+    """
+    Returns current Dataset. During a request always the same one is
+    returned, the one current when it was first asked for, so that
+    presence and users read by a view always match.
+    """
+    if has_request_context():
+        dataset = getattr(g, 'dataset', None)
+        if dataset is None:
+            dataset = g.dataset = load_dataset()
+        return dataset
+    return load_dataset()
+
+
 def get_data():
     """
     Extracts presence data from CSV file only for users from XML file.
-    Groups presence data by user_id.
+    Groups presence data by user_id. Result is loaded again when CSV or
+    XML file changes, see get_dataset().
 
     It creates structure like this:
-    data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
+    data = PresenceData({
+        'user_id': UserPresence(),
+    })
+
+    UserPresence keeps days, year-months and start/end seconds since
+    midnight in int32 columns sorted by date. It can still be read like
+    the former {date: {'start': time, 'end': time}} dict:
+    data['user_id'][datetime.date(2013, 10, 1)] == {
+        'start': datetime.time(9, 0, 0),
+        'end': datetime.time(17, 30, 0),
     }
+    PresenceData additionally keeps indexes over all users.
     """
-    data = {}
-    user_data = get_users_data()
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
-
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-
-            if user_id in user_data:
-                data.setdefault(user_id, {})[date] = {
-                    'start': start,
-                    'end': end,
-                }
-
-    return data
+    return get_dataset().presence
 
 
 def get_users_data():
     """
-    It extracts user's name and avatar from XML file.
+    It extracts user's name and avatar from XML file. Result is loaded
+    again when the file changes, see get_dataset().
 
     It creates structure like this:
     data = {
@@ -132,25 +682,186 @@ def get_users_data():
         }
     }
     """
-    data = {}
-    name_reader = etree.parse(app.config['DATA_XML'])
-    server = name_reader.find('server')
-    avatar_base_url = '{0}://{1}'.format(
-        server.find('protocol').text,
-        server.find('host').text
+    return get_dataset().users
+
+
+def save_snapshot():
+    """
+    Parses DATA_CSV and DATA_XML files and saves the result in DATA_SNAPSHOT
+    file, see presence_analyzer.snapshot. Lines appended to DATA_CSV while
+    it is saved are parsed later, by processes loading the snapshot.
+    """
+    csv_path = app.config['DATA_CSV']
+    xml_path = app.config['DATA_XML']
+    csv_info = source_info(csv_path)
+    xml_info = source_info(xml_path)
+    loader = PresenceLoader(csv_path)
+    presence = loader.refresh()
+    users = load_users(xml_path)
+    if not is_current(xml_info, xml_path) or not is_appended(
+            {'prefix_size': csv_info['size'], 'prefix_sha1': csv_info['sha1']},
+            csv_path,
+    ):
+        raise ValueError('Data files changed while saving snapshot')
+
+    # snapshot describes the part of DATA_CSV which has been read, it is
+    # still used after lines are appended to the file
+    state = loader.state()
+    csv_info = prefix_info(csv_path, loader.offset)
+    csv_info.update(
+        size=loader.offset,
+        mtime=state['mtime'] if state['size'] == loader.offset else None,
+        sha1=csv_info['prefix_sha1'],
     )
-    for user in name_reader.find('users').findall('user'):
-        user_id = int(user.attrib['id'])
-        data.setdefault(user_id, {})['avatar'] =\
-            '{0}{1}'.format(
-                avatar_base_url,
-                user.find('avatar').text
+    write_snapshot(
+        app.config['DATA_SNAPSHOT'],
+        presence,
+        state,
+        users,
+        {'DATA_CSV': csv_info, 'DATA_XML': xml_info},
+    )
+
+
+def load_snapshot():
+    """
+    Loads DATA_SNAPSHOT file, when it is configured and was saved from
+    current DATA_CSV and DATA_XML, so that get_data() does not parse them.
+    DATA_CSV may have been appended to since, only new lines are parsed
+    then.
+    With DATA_SNAPSHOT_SHARED presence is memory mapped and shared with
+    other processes using the same snapshot. Returns True if snapshot was
+    loaded.
+    """
+    path = app.config.get('DATA_SNAPSHOT')
+    if not path or not os.path.exists(path):
+        return False
+
+    started = default_timer()
+    try:
+        header, presence = read_snapshot(
+            path,
+            shared=app.config.get('DATA_SNAPSHOT_SHARED', False),
+        )
+        sources = header['sources']
+        is_outdated = not (
+            is_current(sources['DATA_XML'], app.config['DATA_XML']) and (
+                is_current(sources['DATA_CSV'], app.config['DATA_CSV']) or
+                is_appended(sources['DATA_CSV'], app.config['DATA_CSV'])
+            )
         )
-        data[user_id]['name'] = user.find('name').text
+    except (EnvironmentError, EOFError, KeyError, ValueError):
+        log.warning('Cannot read snapshot %s', path, exc_info=True)
+        return False
+    if is_outdated:
+        log.info('Snapshot %s is outdated, ignoring it', path)
+        return False
+
+    get_presence_loader().restore(header['loader'], presence)
+    users = UsersData(
+        (user_id, {'name': name, 'avatar': avatar})
+        for user_id, name, avatar in header['users']
+    )
+    users.build_indexes()
+    users.version = files_version(USERS_FILES)
+    preloaded_users[app.config['DATA_XML']] = users
+    DATA_LOAD_DURATION.observe(default_timer() - started, 'snapshot')
+    return True
+
 
+def refresh_data():
+    """
+    Loads changed data files and replaces cached Dataset, requests keep
+    using the old one until new one is ready. Returns the new Dataset.
+    """
+    return load_dataset.refresh()
+
+
+def reload_data():
+    """
+    Drops cached results and loads data again, from DATA_SNAPSHOT when it
+    is up to date. Returns the new Dataset.
+    """
+    cached.clear()
+    load_snapshot()
+    return load_dataset()
+
+
+def collation_key(text):
+    """
+    Returns key sorting texts according to LC_COLLATE locale setting.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return locale.strxfrm(text or '')
+
+
+class UsersData(dict):
+    """
+    Users, {user_id: {'avatar': ..., 'name': ...}}, with listing of users
+    sorted by name serialized once by build_indexes() after the data is
+    loaded.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(UsersData, self).__init__(*args, **kwargs)
+        self.listing_json = EncodedJSON('[]')
+        # version of source file, see files_version()
+        self.version = None
+
+    def build_indexes(self):
+        """
+        Serializes users listing sorted with collation keys.
+        """
+        listing = [
+            {
+                'user_id': user_id,
+                'name': user.get('name', 'User {0}'.format(user_id)),
+            }
+            for user_id, user in self.iteritems()
+        ]
+        listing.sort(key=lambda user: collation_key(user['name']))
+        self.listing_json = encode_json(listing)
+
+
+def load_users(path):
+    """
+    Reads users from XML file, see get_users_data() for the structure.
+
+    File is parsed as a stream, every <user> element is dropped as soon as
+    it has been read, so memory use does not grow with the file size.
+    <server> element is expected before <users>, as in the intranet feed.
+    """
+    data = UsersData()
+    avatar_base_url = None
+    for __, element in etree.iterparse(path, tag=('server', 'user')):
+        if element.tag == 'server':
+            avatar_base_url = '{0}://{1}'.format(
+                element.findtext('protocol'),
+                element.findtext('host'),
+            )
+        elif element.getparent().tag == 'users':
+            data[int(element.get('id'))] = {
+                'avatar': avatar_base_url + element.findtext('avatar'),
+                'name': element.findtext('name'),
+            }
+        else:
+            continue
+
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    data.build_indexes()
     return data
 
 
+def month_text(year, month):
+    """
+    Formats month for humans, e.g. '2013-September'.
+    """
+    return '{0}-{1}'.format(year, calendar.month_name[month])
+
+
 def get_months():
     """
     Extracts distinct year nad month from result of get_data() function in
@@ -159,24 +870,17 @@ def get_months():
     Returns list like this:
     ['2011-January', '2011-February', '2013-September']
     """
-    data = get_data()
-    months = set()
-    year_month_str = '%Y-%B'
-    for user_id in data:
-        months.update(map(lambda x: x.strftime(year_month_str), data[user_id]))
-
-    return sorted(months, key=lambda x: datetime.strptime(x, year_month_str))
+    return [month_text(year, month) for year, month in get_data().months]
 
 
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
+    items = as_user_presence(items)
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in izip(items.days, items.starts, items.ends):
+        result[weekday(day)].append(end - start)
     return result
 
 
@@ -184,16 +888,15 @@ def group_start_end_time_by_weekday(items):
     """
     Groups mean start and end time by weekday.
     """
-    time = [{'start': [], 'end': []} for i in range(7)]
-    for date in items:
-        time[date.weekday()]['start'].append(
-            seconds_since_midnight(items[date]['start']))
-        time[date.weekday()]['end'].append(
-            seconds_since_midnight(items[date]['end']))
+    items = as_user_presence(items)
+    times = [{'start': [], 'end': []} for i in range(7)]
+    for day, start, end in izip(items.days, items.starts, items.ends):
+        times[weekday(day)]['start'].append(start)
+        times[weekday(day)]['end'].append(end)
 
     result = [[] for i in range(7)]
-    for weekday, values in enumerate(time):
-        result[weekday] = [mean(values['start']), mean(values['end'])]
+    for day, values in enumerate(times):
+        result[day] = [mean(values['start']), mean(values['end'])]
 
     return result
 
@@ -202,22 +905,18 @@ def group_by_month_and_year(items):
     """
     Groups presence time by months and year.
     """
+    items = as_user_presence(items)
+    by_month = defaultdict(list)
+    for month, start, end in izip(items.months, items.starts, items.ends):
+        by_month[month].append(end - start)
+
     result = defaultdict(list)
-    for date in items:
-        result[date.strftime('%Y-%m')].append(
-            interval(items[date]['start'], items[date]['end'])
-        )
+    for month, intervals in by_month.iteritems():
+        result[format_year_month(month)] = intervals
 
     return result
 
 
-def seconds_since_midnight(time):
-    """
-    Calculates amount of seconds since midnight.
-    """
-    return time.hour * 3600 + time.minute * 60 + time.second
-
-
 def interval(start, end):
     """
     Calculates inverval in seconds between two datetime.time objects.
@@ -230,3 +929,82 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+# fields of records streamed by export view, per kind of records
+EXPORT_FIELDS = {
+    'users': ('user_id', 'name', 'days', 'presence_time'),
+    'days': ('user_id', 'date', 'start', 'end', 'presence_time'),
+}
+# bytes of encoded records sent to the client at once
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def export_records(data, users_data, kind):
+    """
+    Iterates over export records of given kind, tuples of EXPORT_FIELDS
+    values, ordered by user id and date. Records are produced one by one
+    from get_data() structures, nothing is copied.
+    """
+    for user_id in sorted(data):
+        presence = data[user_id]
+        if kind == 'users':
+            yield (
+                user_id,
+                users_data.get(user_id, {}).get('name'),
+                len(presence),
+                sum(presence.aggregates.weekday_totals),
+            )
+            continue
+
+        for day, __, start, end in presence.rows():
+            yield (
+                user_id,
+                date.fromordinal(day).isoformat(),
+                time_from_seconds(start).isoformat(),
+                time_from_seconds(end).isoformat(),
+                end - start,
+            )
+
+
+def ndjson_lines(fields, records):
+    """
+    Encodes records as lines of newline delimited JSON objects.
+    """
+    encoder = get_json_encoder()
+    for record in records:
+        yield encoder(dict(izip(fields, record))) + '\n'
+
+
+def csv_lines(fields, records):
+    """
+    Encodes records as CSV lines preceded by header line.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in chain([fields], records):
+        writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def chunked(lines, size=EXPORT_CHUNK_SIZE):
+    """
+    Joins lines into chunks of at least 'size' bytes, the last one may be
+    shorter.
+    """
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
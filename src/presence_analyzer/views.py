@@ -4,24 +4,26 @@ Defines views.
 """
 
 import calendar
-from datetime import datetime
-from flask import redirect, request, abort
+from flask import Response, redirect, request, abort
 from flask.ext.mako import render_template
-from flask_login import login_user, logout_user
+from flask_login import current_user, login_user, logout_user
 from flask_user import login_required
 import locale
 from mako.exceptions import TopLevelLookupException
 
-from presence_analyzer.main import app
+from presence_analyzer import metrics
+from presence_analyzer.main import app, forget_user
+from presence_analyzer.passwords import hash_password
+from presence_analyzer.store import format_year_month
 from presence_analyzer.utils import (
+    EXPORT_FIELDS,
+    chunked,
+    csv_lines,
+    export_records,
     get_data,
-    get_months,
     get_users_data,
-    group_by_month_and_year,
-    group_by_weekday,
-    group_start_end_time_by_weekday,
     jsonify,
-    mean
+    ndjson_lines,
 )
 
 import logging
@@ -29,6 +31,69 @@ log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
 
+TOP_EMPLOYEES_LIMIT = 5
+
+
+def mean_time_weekday_series(presence):
+    """
+    Mean presence time of user grouped by weekday.
+    """
+    weekdays = presence.aggregates.mean_by_weekday()
+    return [
+        (calendar.day_abbr[weekday], mean_time)
+        for weekday, mean_time in enumerate(weekdays)
+    ]
+
+
+def presence_weekday_series(presence):
+    """
+    Total presence time of user grouped by weekday, with header row.
+    """
+    weekdays = presence.aggregates.weekday_totals
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total in enumerate(weekdays)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def start_end_weekday_series(presence):
+    """
+    Mean start and end time of user grouped by weekday.
+    """
+    weekdays = presence.aggregates.mean_start_end_by_weekday()
+    return [
+        (calendar.day_abbr[weekday], start, end)
+        for weekday, (start, end) in enumerate(weekdays)
+    ]
+
+
+def month_and_year_series(presence):
+    """
+    Total presence time of user grouped by month and year.
+    """
+    month_totals = presence.aggregates.month_totals
+    return [
+        (format_year_month(year_month), total)
+        for year_month, total in sorted(month_totals.iteritems())
+    ]
+
+
+# encoders and mimetypes of export view formats
+EXPORT_FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
+
+# series available in batch view, same as the per-user endpoints
+SERIES = {
+    'mean_time_weekday': mean_time_weekday_series,
+    'presence_weekday': presence_weekday_series,
+    'start_end_weekday': start_end_weekday_series,
+    'month_and_year': month_and_year_series,
+}
+
 
 @app.route('/')
 def mainpage():
@@ -51,12 +116,12 @@ def register():
     if request.method == 'POST' and register_form.validate():
         user_fields = {
             'username': register_form.data['username'],
-            'password': user_manager.hash_password(
-                register_form.data['password']
-            ),
+            'password': hash_password(register_form.data['password']),
         }
-        db_adapter.add_object(db_adapter.UserClass, **user_fields)
+        user = db_adapter.add_object(db_adapter.UserClass, **user_fields)
         db_adapter.commit()
+        # id may have belonged to a removed user
+        forget_user(user.id)
         return redirect('/user/login/')
 
     return render_template('register.html', form=register_form)
@@ -88,6 +153,7 @@ def logout():
     Logout current user. If success redirects to /logout-success/ and
     renders logout_success.html template.
     """
+    forget_user(current_user.id)
     logout_user()
     return render_template('logout_success.html')
 
@@ -104,6 +170,19 @@ def views(view_name):
         abort(404)
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Request, cache and data loading metrics in Prometheus text format.
+    Available to logged in users and to addresses listed in
+    METRICS_ALLOWED_IPS, e.g. of the Prometheus server.
+    """
+    if request.remote_addr not in app.config.get('METRICS_ALLOWED_IPS', ()) \
+            and not current_user.is_authenticated:
+        abort(403)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @login_required
 @jsonify
@@ -111,17 +190,7 @@ def users_view():
     """
     Sorted users listing for dropdown.
     """
-    data = get_users_data()
-    result = [
-        {
-            'user_id': i,
-            'name': data[i].get('name', 'User {0}'.format(i)),
-        }
-        for i in data.keys()
-    ]
-
-    result.sort(key=lambda x: x['name'], cmp=locale.strcoll)
-    return result
+    return get_users_data().listing_json
 
 
 @app.route('/api/v1/months', methods=['GET'])
@@ -138,17 +207,7 @@ def months_view():
         {'year': 2013, 'month': 9, 'text': '2013-September'},
     ]
     """
-    data = get_months()
-    result = [
-        {
-            'year': datetime.strptime(date, '%Y-%B').year,
-            'month': datetime.strptime(date, '%Y-%B').month,
-            'text': date,
-        }
-        for date in data
-    ]
-
-    return result
+    return get_data().months_json
 
 
 @app.route('/api/v1/users/<int:user_id>', methods=['GET'])
@@ -181,13 +240,7 @@ def mean_time_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    return mean_time_weekday_series(data[user_id])
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -202,14 +255,7 @@ def presence_weekday_view(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday_series(data[user_id])
 
 
 @app.route('/api/v1/start_end_weekday/<int:user_id>', methods=['GET'])
@@ -224,13 +270,7 @@ def start_end_weekday(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_start_end_time_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], start, end)
-        for weekday, (start, end) in enumerate(weekdays)
-    ]
-
-    return result
+    return start_end_weekday_series(data[user_id])
 
 
 @app.route('/api/v1/month_and_year/<int:user_id>', methods=['GET'])
@@ -245,12 +285,7 @@ def month_and_year_presence(user_id):
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    year_months = group_by_month_and_year(data[user_id])
-    result = [
-        (year_month, sum(intervals))
-        for year_month, intervals in year_months.items()
-    ]
-    return result
+    return month_and_year_series(data[user_id])
 
 
 @app.route('/api/v1/top_employees/<int:year>/<int:month>', methods=['GET'])
@@ -258,7 +293,8 @@ def month_and_year_presence(user_id):
 @jsonify
 def employees_in_year_month(year, month):
     """
-    Returns top 5 employees in month and year.
+    Returns top employees in month and year, 5 unless 'limit' query
+    parameter says otherwise.
 
     It returns structure like this:
     data = [
@@ -282,25 +318,114 @@ def employees_in_year_month(year, month):
         },
     ]
     """
+    limit = request.args.get('limit', TOP_EMPLOYEES_LIMIT, type=int)
+    if limit < 1:
+        log.debug('Invalid limit %s!', limit)
+        abort(400)
+
     data = get_data()
+    users_data = get_users_data()
     result = []
-    year_month = '{0}-{1:02}'.format(year, month)
-    for user_id in data:
-        grouped = group_by_month_and_year(data[user_id])
+    for user_id, presence_time in data.top_in_month(year, month, limit):
+        user_data = users_data[user_id]
         result.append({
             'id': user_id,
-            'presence_time': sum(grouped[year_month]),
+            'presence_time': presence_time,
+            'name': user_data.get('name', 'User {0}'.format(user_id)),
+            'avatar': user_data.get('avatar', None),
         })
 
-    result.sort(key=lambda x: x['presence_time'], reverse=True)
-    result = result[:5]
+    return result
+
 
+@app.route('/api/v1/batch', methods=['GET'])
+@login_required
+@jsonify
+def batch_view():
+    """
+    Returns many series of many users computed from one data snapshot.
+    Users and series are given as comma separated 'users' and 'series'
+    query parameters, all series are returned when 'series' is missing,
+    e.g. /api/v1/batch?users=10,11&series=mean_time_weekday,presence_weekday
+
+    It returns structure like this:
+    data = {
+        '10': {
+            'real_name': 'Jan P.',
+            'avatar': 'https://intranet.stxnext.pl/api/images/users/10',
+            'mean_time_weekday': [['Mon', 0], ...],
+            'presence_weekday': [['Weekday', 'Presence (s)'], ...],
+        },
+        '99': None,
+    }
+    Users without presence data are None. At most 'BATCH_MAX_USERS' users
+    can be asked for at once.
+    """
+    user_ids = request.args.get('users', '').split(',')
+    if len(user_ids) > app.config.get('BATCH_MAX_USERS', 100):
+        log.debug('Too many users: %d!', len(user_ids))
+        abort(400)
+    try:
+        user_ids = [int(user_id) for user_id in user_ids]
+    except ValueError:
+        log.debug('Invalid users %s!', request.args.get('users'))
+        abort(400)
+
+    series = request.args.get('series')
+    series = series.split(',') if series else sorted(SERIES)
+    if not set(series) <= set(SERIES):
+        log.debug('Invalid series %s!', series)
+        abort(400)
+
+    data = get_data()
     users_data = get_users_data()
-    for user in result:
-        user_id = user['id']
-        user.update(
-            name=users_data[user_id].get('name', 'User {0}'.format(user_id)),
-            avatar=users_data[user_id].get('avatar', None),
-        )
+    result = {}
+    for user_id in user_ids:
+        if user_id not in data:
+            result[str(user_id)] = None
+            continue
+
+        user_data = users_data[user_id]
+        user_result = {
+            'real_name': user_data.get('name', None),
+            'avatar': user_data.get('avatar', None),
+        }
+        for name in series:
+            user_result[name] = SERIES[name](data[user_id])
+        result[str(user_id)] = user_result
 
     return result
+
+
+@app.route('/api/v1/export', methods=['GET'])
+@login_required
+def export_view():
+    """
+    Streams presence of all users as NDJSON or CSV, selected by 'format'
+    query parameter. 'records' parameter selects one record per user
+    ('users', default) or per user and day ('days'). Records are encoded
+    while they are sent, so memory use does not depend on their number.
+
+    Records look like this:
+    users: {"user_id": 10, "name": "Jan P.", "days": 3,
+            "presence_time": 78217}
+    days: {"user_id": 10, "date": "2013-09-10", "start": "09:39:05",
+           "end": "17:59:52", "presence_time": 30047}
+    """
+    kind = request.args.get('records', 'users')
+    export_format = request.args.get('format', 'ndjson')
+    if kind not in EXPORT_FIELDS or export_format not in EXPORT_FORMATS:
+        log.debug('Invalid export %s of %s!', export_format, kind)
+        abort(400)
+
+    encoder, mimetype = EXPORT_FORMATS[export_format]
+    filename = 'presence-{0}.{1}'.format(kind, export_format)
+    lines = encoder(
+        EXPORT_FIELDS[kind],
+        export_records(get_data(), get_users_data(), kind),
+    )
+    return Response(
+        chunked(lines),
+        mimetype=mimetype,
+        headers={'Content-Disposition': 'attachment; filename=' + filename},
+    )